@@ -0,0 +1,464 @@
+# Offline benchmark / soak test for the playback pipeline.
+# Drives the real GuildPlayer, play_audio_at_position, update_ui and heartbeat code against a stub
+# voice client that pulls frames at the real 20ms cadence, a stub text channel, and a local HTTP
+# server standing in for YouTube - no Discord connection or network access needed.
+#
+#   python benchmark.py                          # 1, 10 and 100 guilds, 20s each
+#   python benchmark.py --guilds 1 25 --seconds 60 --mode opus --media song.webm
+#   python benchmark.py --same-track             # every guild plays the same video ID (shared decoding)
+#   python benchmark.py --check-skips            # unavailable queue entries are skipped after the interaction expired
+import os
+
+# Keep benchmark runs from writing the bot's log file or state database, and keep background
+# loudness measurements out of the CPU numbers
+os.environ.setdefault("MUSICBOT_LOG_FILE", "")
+os.environ.setdefault("MUSICBOT_STATE_DB", "")
+os.environ.setdefault("MUSICBOT_METRICS_PORT", "0")
+os.environ.setdefault("MUSICBOT_LOUDNESS_NORMALIZE", "0")
+
+import argparse
+import asyncio
+import functools
+import http.server
+import itertools
+import logging
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import discord
+
+import musicbot
+
+try:
+    import resource  # Child CPU accounting - not available on Windows
+except ImportError:
+    resource = None
+
+bot = musicbot.bot
+TONE_VIDEO_ID = "benchmark-tone"
+
+# Local file server standing in for YouTube's media hosts
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def start_media_server(directory):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, name="media-server", daemon=True).start()
+    return server
+
+# Generate a test tone in a format the bot would normally get from YouTube
+def make_media(ffmpeg, directory, duration):
+    if ffmpeg.has_libopus:
+        name, codec = "tone.webm", ["-c:a", "libopus", "-b:a", "128k"]
+    else:
+        name, codec = "tone.m4a", ["-c:a", "aac", "-b:a", "128k"]
+    path = os.path.join(directory, name)
+    subprocess.run(
+        [ffmpeg.path, "-hide_banner", "-loglevel", "error", "-y",
+         "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+         "-ac", "2", *codec, path],
+        check=True
+    )
+    return name
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def format_ms(seconds):
+    return "n/a" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+# Stub Discord objects - just enough surface for the code paths the bot uses
+class StubMessage:
+    ids = itertools.count(1)
+
+    def __init__(self, channel, embed=None):
+        self.id = next(self.ids)
+        self.channel = channel
+        self.embeds = [embed] if embed else []
+        self.edits = 0
+
+    async def edit(self, embed=None, view=None, **kwargs):
+        self.edits += 1
+        if embed is not None:
+            self.embeds = [embed]
+
+    async def delete(self):
+        pass
+
+class StubPermissions:
+    send_messages = True
+
+class StubTextChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id
+        self.sent = 0
+        self.messages = []  # Plain-text messages, for the checks
+
+    def permissions_for(self, member):
+        return StubPermissions()
+
+    async def send(self, content=None, embed=None, view=None, **kwargs):
+        self.sent += 1
+        if content is not None:
+            self.messages.append(content)
+        return StubMessage(self, embed)
+
+class StubHTTPResponse:
+    status = 404
+    reason = "Not Found"
+
+# Followups through an interaction whose 15-minute token has run out fail with Unknown Webhook
+class ExpiredFollowup:
+    async def send(self, *args, **kwargs):
+        raise discord.NotFound(StubHTTPResponse(), {"code": 10015, "message": "Unknown Webhook"})
+
+class StubExpiredResponse:
+    def is_done(self):
+        return True
+
+class StubExpiredInteraction:
+    def __init__(self, channel):
+        self.channel = channel
+        self.guild = channel.guild
+        self.followup = ExpiredFollowup()
+        self.response = StubExpiredResponse()
+        self.expires_at = None
+
+class StubVoiceChannel:
+    def __init__(self, guild, stats):
+        self.guild = guild
+        self.id = guild.id
+        self.stats = stats
+
+    # Used by reconnect_voice_client when the heartbeat decides playback stalled
+    async def connect(self):
+        return StubVoiceClient(self.guild, self, self.stats)
+
+class StubGuild:
+    def __init__(self, guild_id, stats):
+        self.id = guild_id
+        self.me = None
+        self.voice_client = None
+        self.text_channels = [StubTextChannel(self)]
+        self.voice_channel = StubVoiceChannel(self, stats)
+
+# Frame timing shared by every stub voice client in a run
+class FrameStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jitter = []  # Seconds each frame was handed over after its 20ms slot
+        self.frames = 0
+        self.late_frames = 0  # Frames more than one slot late
+        self.encode_seconds = 0.0
+
+    def record(self, jitter, encode_seconds):
+        with self.lock:
+            self.jitter.append(jitter)
+            self.frames += 1
+            self.encode_seconds += encode_seconds
+            if jitter > musicbot.FRAME_DURATION:
+                self.late_frames += 1
+
+def make_encoder():
+    try:
+        if not discord.opus.is_loaded():
+            discord.opus._load_default()
+        if discord.opus.is_loaded():
+            return discord.opus.Encoder()
+    except Exception:
+        pass
+    return None
+
+# Consumes audio like discord.py's AudioPlayer: one read (and Opus encode for PCM) per 20ms slot
+class StubVoiceClient:
+    def __init__(self, guild, channel, stats):
+        self.guild = guild
+        self.channel = channel
+        self.stats = stats
+        self.encoder = make_encoder()
+        self.source = None
+        self.thread = None
+        self.end = None
+        self.resumed = None
+        guild.voice_client = self
+
+    def play(self, source, after=None):
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+        self.source = source
+        self.end = threading.Event()
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.thread = threading.Thread(target=self._run, args=(source, after, self.end, self.resumed), name="stub-voice", daemon=True)
+        self.thread.start()
+
+    def _run(self, source, after, end, resumed):
+        error = None
+        loops = 0
+        start = time.perf_counter()
+        try:
+            while not end.is_set():
+                if not resumed.is_set():
+                    resumed.wait()
+                    loops = 0
+                    start = time.perf_counter()
+                    continue
+                due = start + loops * musicbot.FRAME_DURATION
+                data = source.read()
+                if not data:
+                    break
+                encode_seconds = 0.0
+                if self.encoder is not None and not source.is_opus():
+                    encode_start = time.perf_counter()
+                    self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+                    encode_seconds = time.perf_counter() - encode_start
+                self.stats.record(max(0.0, time.perf_counter() - due), encode_seconds)
+                loops += 1
+                delay = start + loops * musicbot.FRAME_DURATION - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+            if after is not None:
+                after(error)
+
+    def is_playing(self):
+        return self.thread is not None and self.thread.is_alive() and not self.end.is_set() and self.resumed.is_set()
+
+    def is_paused(self):
+        return self.thread is not None and self.thread.is_alive() and not self.resumed.is_set()
+
+    def is_connected(self):
+        return self.guild.voice_client is self
+
+    def stop(self):
+        if self.end is not None:
+            self.end.set()
+            self.resumed.set()
+
+    def pause(self):
+        if self.resumed is not None:
+            self.resumed.clear()
+
+    def resume(self):
+        if self.resumed is not None:
+            self.resumed.set()
+
+    async def disconnect(self, force=False):
+        self.stop()
+        if self.guild.voice_client is self:
+            self.guild.voice_client = None
+
+def child_cpu_seconds():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+# Play one track in each of guild_count simulated guilds for the given time and collect the numbers
+async def run_scenario(guild_count, seconds, url, duration, same_track=False):
+    musicbot.metrics = musicbot.Metrics()  # Fresh histograms per scenario
+    await musicbot.metrics.start(bot)
+    stats = FrameStats()
+    ui_before = bot.ui_scheduler.stats()["edits_sent"]
+    spawned_before = bot.processes.stats()["spawned"]
+    heartbeat_passes = []
+
+    cpu_start = time.process_time()
+    children_start = child_cpu_seconds()
+    wall_start = time.perf_counter()
+
+    guilds = [StubGuild(900_000 + i, stats) for i in range(guild_count)]
+
+    async def start(guild):
+        vc = StubVoiceClient(guild, guild.voice_channel, stats)
+        player = bot.get_player(guild)
+        player.current_song = url
+        player.current_duration = duration
+        player.current_timestamp = 0
+        if same_track:
+            player.current_video_id = TONE_VIDEO_ID
+        interaction = musicbot.ChannelInteraction(guild.text_channels[0])
+        await musicbot.play_audio_at_position(vc, interaction, url, 0, duration, f"Benchmark tone {guild.id}")
+
+    await asyncio.gather(*(start(guild) for guild in guilds))
+
+    # Our own heartbeat pass - the real loop would evict the stub guilds because get_guild() can't see them
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(min(1.0, max(0.0, deadline - time.perf_counter())))
+        pass_start = time.perf_counter()
+        now = time.time()
+        for guild in guilds:
+            player = bot.players.get(guild.id)
+            if player is not None:
+                bot.check_player_health(player, guild, now)
+        heartbeat_passes.append(time.perf_counter() - pass_start)
+
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    underruns = musicbot.metrics.underruns.value
+    recoveries = musicbot.metrics.recoveries.value
+
+    for guild in guilds:
+        if guild.voice_client is not None:
+            guild.voice_client.stop()
+        bot.evict_player(guild.id)
+    # Wait for ffmpeg to be reaped so its CPU time shows up in the child rusage
+    reap_deadline = time.perf_counter() + 10
+    while bot.processes.stats()["alive"] and time.perf_counter() < reap_deadline:
+        await asyncio.sleep(0.1)
+    children = child_cpu_seconds()
+    await musicbot.metrics.shutdown()
+
+    return {
+        "guilds": guild_count,
+        "first_audio_p50": musicbot.metrics.first_audio_seconds.quantile(0.5),
+        "first_audio_p99": musicbot.metrics.first_audio_seconds.quantile(0.99),
+        "jitter_p50": percentile(stats.jitter, 0.5),
+        "jitter_p99": percentile(stats.jitter, 0.99),
+        "jitter_max": max(stats.jitter) if stats.jitter else None,
+        "frames": stats.frames,
+        "late_frames": stats.late_frames,
+        "underruns": underruns,
+        "recoveries": recoveries,
+        "bot_cpu_per_stream": cpu / wall / guild_count,
+        "encode_cpu_per_stream": stats.encode_seconds / wall / guild_count,
+        "ffmpeg_cpu_per_stream": (children - children_start) / wall / guild_count if children is not None else None,
+        "loop_lag_p99": musicbot.metrics.loop_lag_seconds.quantile(0.99),
+        "loop_lag_count": musicbot.metrics.loop_lag_seconds.count,
+        "heartbeat_max": max(heartbeat_passes) if heartbeat_passes else None,
+        "ui_edits": bot.ui_scheduler.stats()["edits_sent"] - ui_before,
+        "decoders": bot.processes.stats()["spawned"] - spawned_before,
+    }
+
+def print_results(results, encoder):
+    print()
+    print(f"{'guilds':>6} {'first audio p50/p99':>20} {'jitter p50/p99/max':>26} {'late':>6} {'underruns':>9} "
+          f"{'bot cpu':>8} {'ffmpeg cpu':>10} {'decoders':>8} {'loop lag p99':>12} {'heartbeat':>10} {'ui edits':>8}")
+    for r in results:
+        ffmpeg_cpu = f"{r['ffmpeg_cpu_per_stream'] * 100:.1f}%" if r["ffmpeg_cpu_per_stream"] is not None else "n/a"
+        print(
+            f"{r['guilds']:>6} "
+            f"{musicbot.format_latency(r['first_audio_p50']) + ' / ' + musicbot.format_latency(r['first_audio_p99']):>20} "
+            f"{format_ms(r['jitter_p50']) + ' / ' + format_ms(r['jitter_p99']) + ' / ' + format_ms(r['jitter_max']):>26} "
+            f"{r['late_frames']:>6} {r['underruns']:>9} "
+            f"{r['bot_cpu_per_stream'] * 100:>7.1f}% {ffmpeg_cpu:>10} {r['decoders']:>8} "
+            f"{musicbot.format_latency(r['loop_lag_p99']):>12} {format_ms(r['heartbeat_max']):>10} {r['ui_edits']:>8}"
+        )
+    print()
+    print("CPU figures are percent of one core per stream. "
+          + ("Bot CPU includes Opus encoding of PCM frames." if encoder else "libopus isn't loadable here, so PCM frames were not Opus-encoded."))
+    if any(r["recoveries"] for r in results):
+        print("The heartbeat restarted stalled playback: " + ", ".join(f"{r['recoveries']} at {r['guilds']} guilds" for r in results if r["recoveries"]))
+
+# A lazily resolved playlist with a private video in it, played long after /play: the prefetcher
+# must try the bad entry once, playback must skip it with a notice in the channel, and the song
+# after it must play. Returns a list of failures.
+async def check_unavailable_entries(url):
+    stats = FrameStats()
+    guild = StubGuild(800_000, stats)
+    vc = StubVoiceClient(guild, guild.voice_channel, stats)
+    player = bot.get_player(guild)
+    channel = guild.text_channels[0]
+    interaction = StubExpiredInteraction(channel)
+    first, private, last = "aaaaaaaaaaa", "bbbbbbbbbbb", "ccccccccccc"
+    lookups = []
+
+    async def stream_url(video_id, min_validity=0):
+        lookups.append(video_id)
+        if video_id == private:
+            raise Exception("ERROR: [youtube] bbbbbbbbbbb: Private video")
+        return url
+
+    real_stream_url = bot.metadata_cache.stream_url
+    bot.metadata_cache.stream_url = stream_url
+    try:
+        player.queue.extend([(first, "First song", 2), (private, "Private song", 2), (last, "Last song", 2)])
+        await musicbot.play_next_in_queue(vc, interaction)
+        # The UI loop's prefetch runs every second near the end of a song
+        for _ in range(3):
+            await player._update_ui(vc, interaction)
+            if player.prefetch_task is not None:
+                await player.prefetch_task
+        vc.stop()  # The first song ends
+        deadline = time.perf_counter() + 10
+        while player.current_video_id != last and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        playing, queued = player.current_video_id, len(player.queue)
+    finally:
+        bot.metadata_cache.stream_url = real_stream_url
+        if guild.voice_client is not None:
+            guild.voice_client.stop()
+        bot.evict_player(guild.id)
+
+    failures = []
+    if playing != last:
+        failures.append(f"expected {last} to be playing, got {playing} with {queued} queued")
+    if lookups.count(private) != 2:
+        failures.append(f"expected the private entry to be resolved twice (prefetch, then play), got {lookups.count(private)}")
+    if not any("Couldn't load" in message for message in channel.messages):
+        failures.append("no skip notice was posted to the channel")
+    return failures
+
+async def main(args):
+    if args.mode:
+        musicbot.AUDIO_MODE = args.mode
+    await bot._async_setup_hook()
+    bot._ready.set()  # update_ui waits for this
+    bot.ffmpeg = await asyncio.to_thread(musicbot.FFmpegCapabilities.probe)
+
+    with tempfile.TemporaryDirectory(prefix="musicbot-bench-") as directory:
+        duration = args.seconds + 10  # Never let the track end mid-measurement
+        if args.media:
+            name = os.path.basename(args.media)
+            shutil.copy(args.media, os.path.join(directory, name))
+        else:
+            name = await asyncio.to_thread(make_media, bot.ffmpeg, directory, duration)
+        server = start_media_server(directory)
+        url = f"http://127.0.0.1:{server.server_address[1]}/{name}"
+        print(f"Serving {name} from {url} in {musicbot.AUDIO_MODE} mode")
+        if args.same_track:
+            # Make the tone look like an already-resolved track so the bot never tries to reach YouTube
+            bot.metadata_cache._store({"id": TONE_VIDEO_ID, "title": "Benchmark tone", "duration": duration, "url": url}, url)
+
+        results = []
+        try:
+            if args.check_skips:
+                failures = await check_unavailable_entries(url)
+                print("Skipping unavailable songs: " + ("ok" if not failures else "FAILED\n  " + "\n  ".join(failures)))
+                return not failures
+            for guild_count in args.guilds:
+                print(f"Running {guild_count} guild(s) for {args.seconds:g}s...")
+                results.append(await run_scenario(guild_count, args.seconds, url, duration, args.same_track))
+        finally:
+            server.shutdown()
+            bot.ui_scheduler.shutdown()
+            bot.processes.kill_all()
+        print_results(results, make_encoder() is not None)
+        return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline playback benchmark with stub voice clients and local media")
+    parser.add_argument("--guilds", type=int, nargs="+", default=[1, 10, 100], help="Concurrent guild counts to simulate")
+    parser.add_argument("--seconds", type=float, default=20, help="Playback time per scenario")
+    parser.add_argument("--mode", choices=["pcm", "opus"], help="Override MUSICBOT_AUDIO_MODE")
+    parser.add_argument("--media", help="Audio file to play instead of a generated tone")
+    parser.add_argument("--same-track", action="store_true", help="Give every guild the same video ID so PCM mode can share decoders")
+    parser.add_argument("--check-skips", action="store_true", help="Only check that unavailable queue entries are skipped, then exit")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's info logs")
+    args = parser.parse_args()
+    musicbot.setup_logging()
+    if not args.verbose:
+        logging.getLogger("MusicBot").setLevel(logging.WARNING)
+    raise SystemExit(0 if asyncio.run(main(args)) else 1)
@@ -1,202 +1,2924 @@
+import time
+STARTED_AT = time.perf_counter()  # Boot clock for the time-to-ready log, taken before the heavy imports
+
 import os
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
-from yt_dlp import YoutubeDL
 import subprocess
-from collections import deque
+import shutil
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timezone
 import asyncio
-import psutil
-import time
 import logging
+import re
+import threading
+import audioop
+import ctypes
+import struct
+import bisect
+import random
+import sqlite3
+import hashlib
+import json
+import atexit
+import itertools
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from urllib.parse import urlparse, parse_qs
+from musicbot_workers import FRAME_SIZE, audio_worker_main, extract_info_blocking, read_frame_into
+
+# Logging settings
+LOG_FILE = os.getenv("MUSICBOT_LOG_FILE", "bot.log")
+LOG_MAX_MB = float(os.getenv("MUSICBOT_LOG_MAX_MB", "10"))  # Rotate the log file at this size
+LOG_BACKUPS = int(os.getenv("MUSICBOT_LOG_BACKUPS", "5"))  # Rotated files to keep
+LOG_SUMMARY_INTERVAL = float(os.getenv("MUSICBOT_LOG_SUMMARY_INTERVAL", "10"))  # Seconds per hot-path warning summary
+
+# Set up logging - callers (including the voice thread) only put records on a queue;
+# a background listener thread does the formatting and the disk/console I/O.
+# Only called by whatever runs the bot: spawned worker processes re-import this module,
+# and must not open (and rotate) the log file a second time.
+def setup_logging():
+    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        log_handlers.append(RotatingFileHandler(LOG_FILE, maxBytes=int(LOG_MAX_MB * 1024 * 1024), backupCount=LOG_BACKUPS, encoding="utf-8"))
+    for handler in log_handlers:
+        handler.setFormatter(log_formatter)
+    log_queue = SimpleQueue()
+    log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)  # Flush whatever is still queued on exit
+    # No formatter on the queue side - the listener's handlers do the formatting
+    logging.root.addHandler(QueueHandler(log_queue))
+    logging.root.setLevel(logging.INFO)
+
+logger = logging.getLogger("MusicBot")
+
+# Folds a hot-path warning into one summary line per interval instead of one line per event.
+# The first event after a quiet interval is logged straight away.
+class LogSummary:
+    def __init__(self, message, interval=LOG_SUMMARY_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.window_start = time.monotonic() - interval
+
+    def record(self, value):
+        with self.lock:
+            self.count += 1
+            self.total += value
+            self.worst = max(self.worst, value)
+        if time.monotonic() - self.window_start >= self.interval:
+            self.flush()
+
+    # Log and reset the current window; the heartbeat calls this so a burst is never left unreported
+    def flush(self):
+        with self.lock:
+            if self.count == 0:
+                self.window_start = time.monotonic()
+                return
+            count, total, worst = self.count, self.total, self.worst
+            elapsed = time.monotonic() - self.window_start
+            self.count, self.total, self.worst = 0, 0.0, 0.0
+            self.window_start = time.monotonic()
+        if count == 1:
+            logger.warning(f"{self.message}: {worst:.3f}s")
+        else:
+            logger.warning(f"{self.message}: {count} in the last {elapsed:.0f}s (avg {total / count:.3f}s, worst {worst:.3f}s)")
+
+read_delays = LogSummary("Audio read delay")
+
+intents = discord.Intents.default()
+intents.message_content = True
+
+# Extraction pool settings (override with environment variables)
+EXTRACTION_EXECUTOR = os.getenv("MUSICBOT_EXTRACTION_EXECUTOR", "thread")  # "thread" or "process"
+EXTRACTION_WORKERS = int(os.getenv("MUSICBOT_EXTRACTION_WORKERS", "4"))
+EXTRACTION_TIMEOUT = float(os.getenv("MUSICBOT_EXTRACTION_TIMEOUT", "30"))
+PLAYLIST_MAX_ENTRIES = int(os.getenv("MUSICBOT_PLAYLIST_MAX_ENTRIES", "500"))
+
+# Metadata cache settings
+METADATA_CACHE_SIZE = int(os.getenv("MUSICBOT_METADATA_CACHE_SIZE", "2048"))
+STREAM_URL_DEFAULT_TTL = 1800  # Used when a stream URL carries no expire parameter
+STREAM_URL_REFRESH_MARGIN = 60  # Refresh URLs that would expire within this many seconds of use
+
+# Audio pipeline settings
+# "pcm": ffmpeg decodes to s16le and discord.py encodes Opus in-process
+# "opus": ffmpeg remuxes Opus sources (or encodes with libopus) and packets are sent as-is
+AUDIO_MODE = os.getenv("MUSICBOT_AUDIO_MODE", "pcm")
+OPUS_BITRATE = int(os.getenv("MUSICBOT_OPUS_BITRATE", "128"))  # kbps, used when ffmpeg has to encode
+SEEK_BUFFER_SECONDS = float(os.getenv("MUSICBOT_SEEK_BUFFER_SECONDS", "15"))  # Decoded audio kept for instant seeks
+READAHEAD_SECONDS = float(os.getenv("MUSICBOT_READAHEAD_SECONDS", "5"))  # Decoded audio buffered ahead of playback
+FRAME_DURATION = 0.02  # Every frame handed to discord.py is 20ms
+PREFETCH_SECONDS = float(os.getenv("MUSICBOT_PREFETCH_SECONDS", "10"))  # Start the next track's decoder this close to the end
+SHARED_DECODE = os.getenv("MUSICBOT_SHARED_DECODE", "1") != "0"  # PCM mode: guilds playing the same track close together share one ffmpeg
+SHARED_OWNER = "shared"  # ProcessSupervisor key for decoders that no single guild owns
+SILENCE_FRAME = bytes(FRAME_SIZE)
+
+# Audio worker settings - 0 keeps decoding and Opus encoding in the bot process
+AUDIO_WORKERS = int(os.getenv("MUSICBOT_AUDIO_WORKERS", "0"))
+WORKER_CREDIT_FRAMES = 25  # Frames consumed before the worker is told it may produce more
+WORKER_BATCH_FRAMES = 5  # Opus packets per IPC message
+
+# Sharding settings - leave both unset for a single gateway connection
+SHARD_COUNT = os.getenv("MUSICBOT_SHARD_COUNT", "")  # "auto" for Discord's recommended count, or a fixed number
+SHARD_IDS = os.getenv("MUSICBOT_SHARD_IDS", "")  # Shards run by this process, e.g. "0-3" or "0,2,4"; empty for all
+HEARTBEAT_INTERVAL = 10  # Seconds between health passes over a shard's players
+
+# Now Playing UI settings
+UI_UPDATE_INTERVAL = float(os.getenv("MUSICBOT_UI_UPDATE_INTERVAL", "15"))  # Seconds between routine edits per message
+UI_MAX_BACKOFF = 8  # Largest multiplier applied to the interval while Discord is throttling us
+
+# Queue view settings
+QUEUE_PAGE_SIZE = 10  # Songs per /queue page
+QUEUE_TITLE_LENGTH = 70  # Titles are cut to this many characters so a full page fits in one embed field
+QUEUE_VIEW_TIMEOUT = 300  # Seconds before /queue page buttons stop responding
+
+# Health check settings
+STALL_SECONDS = float(os.getenv("MUSICBOT_STALL_SECONDS", "5"))  # No frames sent for this long while playing = stalled
+
+# Disk cache settings - leave the directory empty to disable the cache
+AUDIO_CACHE_DIR = os.getenv("MUSICBOT_AUDIO_CACHE_DIR", "")
+AUDIO_CACHE_MAX_MB = int(os.getenv("MUSICBOT_AUDIO_CACHE_MAX_MB", "2048"))
+AUDIO_CACHE_WORKERS = int(os.getenv("MUSICBOT_AUDIO_CACHE_WORKERS", "2"))  # Concurrent background downloads
+
+# Loudness normalization settings
+LOUDNESS_NORMALIZE = os.getenv("MUSICBOT_LOUDNESS_NORMALIZE", "1") != "0"
+LOUDNESS_TARGET = float(os.getenv("MUSICBOT_LOUDNESS_TARGET", "-14"))  # Integrated loudness (LUFS) tracks are brought to
+LOUDNESS_MAX_GAIN_DB = 12  # Largest boost or cut applied to a track
+LOUDNESS_TOLERANCE_DB = 0.5  # Smaller corrections are skipped, keeping Opus passthrough for tracks already close to target
+LOUDNESS_WORKERS = 1  # Concurrent background measurements
+
+# Saved state settings - leave the path empty to forget queues on restart
+STATE_DB_PATH = os.getenv("MUSICBOT_STATE_DB", "musicbot_state.db")
+STATE_FLUSH_INTERVAL = float(os.getenv("MUSICBOT_STATE_FLUSH_INTERVAL", "5"))  # Seconds between batched writes
+
+# Slash commands are only synced when their definitions differ from the hash saved here (empty = sync every start)
+COMMAND_HASH_FILE = os.getenv("MUSICBOT_COMMAND_HASH_FILE", ".command_tree_hash")
+
+# Improved YoutubeDL options for better stability
+YDL_OPTS = {
+    "format": "bestaudio/best",
+    "noplaylist": True,
+    "quiet": True,
+    "extract_flat": True,  # Playlists are only listed (IDs/titles); streams are resolved when needed
+    "playlistend": PLAYLIST_MAX_ENTRIES,
+    "skip_download": True,
+    "force_generic_extractor": False,
+    # Add timeout options
+    "socket_timeout": 30,
+    "retries": 5,
+    "fragment_retries": 5
+}
+
+# Metrics settings
+METRICS_PORT = int(os.getenv("MUSICBOT_METRICS_PORT", "0"))  # Serve Prometheus text metrics on 127.0.0.1:<port>; 0 disables
+LOOP_LAG_INTERVAL = 0.5  # Seconds between event loop lag probes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FRAME_READ_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5)
+
+# Cumulative histogram in the Prometheus layout; observe() is cheap enough for the voice thread
+class Histogram:
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    # Upper bound of the bucket holding the q-th quantile - good enough for a status embed
+    def quantile(self, q):
+        with self.lock:
+            counts, total = list(self.counts), self.count
+        if total == 0:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float("inf")
+
+    def render(self):
+        with self.lock:
+            counts, total, value_sum = list(self.counts), self.count, self.sum
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total}')
+        lines.append(f"{self.name}_sum {value_sum}")
+        lines.append(f"{self.name}_count {total}")
+        return lines
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+# Process-wide metrics for the playback pipeline. Components that already keep their own
+# counters (extraction pool, caches, UI scheduler, ffmpeg supervisor, state store) are read
+# through their stats() at scrape time instead of being duplicated here.
+class Metrics:
+    def __init__(self):
+        self.extraction_seconds = Histogram("musicbot_extraction_seconds", "yt-dlp extraction latency, including the wait for a worker")
+        self.first_audio_seconds = Histogram("musicbot_first_audio_seconds", "Time from starting a track to handing its first frame to the voice client")
+        self.frame_read_seconds = Histogram("musicbot_frame_read_seconds", "Time the voice thread spent reading one 20ms frame", FRAME_READ_BUCKETS)
+        self.loop_lag_seconds = Histogram("musicbot_event_loop_lag_seconds", "How late the event loop woke up a sleeping task", FRAME_READ_BUCKETS)
+        self.underruns = Counter("musicbot_audio_underruns_total", "Frames the voice thread had to wait for")
+        self.recoveries = Counter("musicbot_playback_recoveries_total", "Stalled playbacks restarted by the heartbeat")
+        self.reconnects = Counter("musicbot_voice_reconnects_total", "Voice reconnect attempts")
+        self.reconnect_failures = Counter("musicbot_voice_reconnect_failures_total", "Voice reconnects that raised")
+        self.lag_task = None
+        self.server = None
+
+    async def start(self, bot):
+        if self.lag_task is None:
+            self.lag_task = asyncio.create_task(self._watch_loop_lag())
+        if METRICS_PORT and self.server is None:
+            self.server = await asyncio.start_server(lambda r, w: self._serve(bot, r, w), "127.0.0.1", METRICS_PORT)
+            logger.info(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+
+    async def _watch_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag_seconds.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+    # Minimal HTTP/1.1 responder - one GET /metrics per connection
+    async def _serve(self, bot, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request.split()
+            if len(parts) > 1 and parts[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", self.render(bot).encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    # Prometheus text exposition of everything we track
+    def render(self, bot):
+        lines = []
+        for metric in (self.extraction_seconds, self.first_audio_seconds, self.frame_read_seconds, self.loop_lag_seconds,
+                       self.underruns, self.recoveries, self.reconnects, self.reconnect_failures):
+            lines.extend(metric.render())
+        gauges = {
+            "players": len(bot.players),
+            "voice_connections": len(bot.voice_clients),
+            "gateway_latency_seconds": bot.latency if bot.latency == bot.latency else 0.0,  # NaN before the first heartbeat
+            "ready_seconds": bot.ready_seconds or 0.0,
+            "setup_seconds": bot.setup_seconds or 0.0,
+        }
+        for name, value in gauges.items():
+            lines.append(f"musicbot_{name} {value}")
+        for prefix, stats in bot.component_stats().items():
+            for key, value in stats.items():
+                lines.append(f"musicbot_{prefix}_{key} {value}")
+        for shard_id, stats in bot.shard_stats().items():
+            for key, value in stats.items():
+                lines.append(f'musicbot_shard_{key}{{shard="{shard_id}"}} {0.0 if value is None else value}')
+        return "\n".join(lines) + "\n"
+
+    async def shutdown(self):
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+metrics = Metrics()
+
+# Bounded worker pool that keeps yt-dlp extraction off the event loop
+class ExtractionPool:
+    def __init__(self, kind=EXTRACTION_EXECUTOR, workers=EXTRACTION_WORKERS, timeout=EXTRACTION_TIMEOUT):
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.executor = None
+        self.semaphore = None
+        # Metrics
+        self.waiting = 0  # Requests queued for a free worker
+        self.running = 0  # Extractions currently executing
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    @property
+    def queue_depth(self):
+        return self.waiting
+
+    def _ensure_started(self):
+        if self.executor is None:
+            if self.kind == "process":
+                # Spawned, not forked - a fork would copy the event loop, gateway sockets and open ffmpeg pipes
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ytdl")
+            self.semaphore = asyncio.Semaphore(self.workers)
+            logger.info(f"Started {self.kind} extraction pool with {self.workers} workers")
+
+    # Extract info for a URL; the timeout is capped by the interaction's expiry when one is given
+    async def extract(self, url, ydl_opts=YDL_OPTS, interaction=None):
+        self._ensure_started()
+        timeout = self.timeout
+        if interaction is not None and interaction.expires_at is not None:
+            remaining = (interaction.expires_at - datetime.now(timezone.utc)).total_seconds()
+            timeout = min(timeout, max(0.0, remaining))
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + timeout
+        self.waiting += 1
+        if self.waiting > 1:
+            logger.info(f"Extraction pool queue depth: {self.waiting}")
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        future = self.executor.submit(extract_info_blocking, url, ydl_opts)
+
+        # Hold the worker slot until the job really finishes, even if we stop waiting for it
+        def release(_):
+            self.running -= 1
+            self.semaphore.release()
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(release, f))
+
+        try:
+            info = await asyncio.wait_for(asyncio.wrap_future(future), max(0.0, deadline - loop.time()))
+            self.completed += 1
+            metrics.extraction_seconds.observe(loop.time() - started)
+            return info
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            future.cancel()
+            logger.warning(f"Extraction timed out after {timeout:.1f}s for URL: {url}")
+            raise
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            future.cancel()
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+
+    def stats(self):
+        return {
+            "queue_depth": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+YOUTUBE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+# Pull the canonical video ID out of common YouTube URL shapes without a network call
+def parse_video_id(url):
+    try:
+        parsed = urlparse(url.strip())
+    except ValueError:
+        return None
+    host = (parsed.hostname or "").lower()
+    candidate = None
+    if host == "youtu.be":
+        candidate = parsed.path.lstrip("/").split("/")[0]
+    elif host == "youtube.com" or host.endswith(".youtube.com"):
+        if parsed.path == "/watch":
+            candidate = parse_qs(parsed.query).get("v", [None])[0]
+        else:
+            parts = parsed.path.strip("/").split("/")
+            if len(parts) >= 2 and parts[0] in ("shorts", "embed", "live", "v"):
+                candidate = parts[1]
+    if candidate and YOUTUBE_ID_RE.match(candidate):
+        return candidate
+    return None
+
+# Work out when a resolved stream URL stops working from its expire parameter
+def stream_url_expiry(stream_url):
+    try:
+        expire = parse_qs(urlparse(stream_url).query).get("expire", [None])[0]
+        if expire is None:
+            # googlevideo also encodes parameters in the path (/expire/1700000000/...)
+            parts = urlparse(stream_url).path.split("/")
+            if "expire" in parts:
+                expire = parts[parts.index("expire") + 1]
+        if expire is not None:
+            return float(expire)
+    except (ValueError, IndexError):
+        pass
+    return time.time() + STREAM_URL_DEFAULT_TTL
+
+# Cached metadata for a single track
+class TrackInfo:
+    __slots__ = ("video_id", "webpage_url", "title", "duration", "stream_url", "expires_at", "acodec")
+
+    def __init__(self, video_id, webpage_url, title, duration, stream_url=None, expires_at=0, acodec=None):
+        self.video_id = video_id
+        self.webpage_url = webpage_url
+        self.title = title
+        self.duration = duration
+        self.stream_url = stream_url
+        self.expires_at = expires_at
+        self.acodec = acodec  # Codec of the selected stream, e.g. "opus" for YouTube WebM audio
+
+    def stream_valid_for(self, seconds):
+        return self.stream_url is not None and self.expires_at - time.time() > seconds
+
+# LRU cache of resolved tracks keyed by video ID - title/duration are kept for the
+# lifetime of the entry, stream URLs only until their expire time
+class MetadataCache:
+    def __init__(self, pool, max_entries=METADATA_CACHE_SIZE):
+        self.pool = pool
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # video id -> TrackInfo
+        self.inflight = {}  # video id / url -> Future, so concurrent lookups share one extraction
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, video_id):
+        track = self.entries.get(video_id)
+        if track is not None:
+            self.entries.move_to_end(video_id)
+        return track
+
+    def _store(self, info, fallback_url):
+        video_id = info.get("id") or fallback_url
+        track = self.entries.get(video_id)
+        if track is None:
+            track = TrackInfo(
+                video_id,
+                info.get("webpage_url") or fallback_url,
+                info.get("title", "Unknown Title"),
+                info.get("duration", 0) or 0,
+            )
+            self.entries[video_id] = track
+        else:
+            # Entries from a flat playlist listing get their full details now
+            track.title = info.get("title") or track.title
+            track.duration = info.get("duration") or track.duration
+        if info.get("url"):
+            track.stream_url = info["url"]
+            track.expires_at = stream_url_expiry(info["url"])
+            track.acodec = info.get("acodec")
+        self.entries.move_to_end(video_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return track
+
+    async def _extract(self, key, url, interaction=None):
+        # Share a single extraction between concurrent requests for the same track
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.pool.extract(url, interaction=interaction))
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    # Resolve a user-supplied URL to a TrackInfo with a usable stream URL
+    async def resolve(self, url, interaction=None):
+        video_id = parse_video_id(url)
+        track = self.get(video_id) if video_id else None
+        if track is not None and track.stream_valid_for(STREAM_URL_REFRESH_MARGIN + track.duration):
+            self.hits += 1
+            return track, None
+        if track is not None:
+            self.refreshes += 1
+        else:
+            self.misses += 1
+        info = await self._extract(video_id or url, url, interaction)
+        if "entries" in info:  # Playlists are returned as-is for the caller to handle
+            return None, info
+        return self._store(info, url), info
+
+    # Register lightweight entries from a flat playlist listing - no stream URLs yet
+    def add_flat_entries(self, entries):
+        tracks = []
+        for entry in entries:
+            if not entry or not entry.get("id") or entry.get("_type") == "playlist":
+                continue
+            track = self.get(entry["id"])
+            if track is None:
+                track = TrackInfo(
+                    entry["id"],
+                    entry.get("url") or entry.get("webpage_url"),
+                    entry.get("title") or "Unknown Title",
+                    entry.get("duration") or 0,
+                )
+                self.entries[track.video_id] = track
+            tracks.append(track)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return tracks
+
+    # Return a stream URL for a track that stays valid for at least min_validity seconds,
+    # doing the full extraction now if the track was only listed (or has expired)
+    async def stream_url(self, video_id, min_validity=0):
+        track = self.get(video_id)
+        if track is None:
+            if not YOUTUBE_ID_RE.match(video_id):
+                raise KeyError(video_id)
+            # Evicted from the cache while it sat in a long queue - rebuild from the ID
+            track = TrackInfo(video_id, f"https://www.youtube.com/watch?v={video_id}", "Unknown Title", 0)
+            self.entries[video_id] = track
+        if track.stream_valid_for(min_validity + STREAM_URL_REFRESH_MARGIN):
+            self.hits += 1
+            return track.stream_url
+        self.refreshes += 1
+        logger.info(f"Refreshing stream URL for {video_id}")
+        info = await self._extract(video_id, track.webpage_url)
+        track = self._store(info, track.webpage_url)
+        if track.stream_url is None:
+            raise ValueError(f"No playable stream for {video_id}")
+        return track.stream_url
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+        }
+
+CACHE_KEY_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Scan an Ogg file's page headers into a list of (granule position, byte offset)
+def build_ogg_index(path):
+    index = []
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            f.seek(offset)
+            header = f.read(27)
+            if len(header) < 27 or header[:4] != b'OggS':
+                break
+            granule = struct.unpack_from('<q', header, 6)[0]
+            segments = f.read(header[26])
+            if granule >= 0:  # -1 means no packet finishes on this page
+                index.append((granule, offset))
+            offset += 27 + len(segments) + sum(segments)
+    return index
+
+# Size-bounded LRU cache of transcoded Ogg/Opus files keyed by video ID
+class AudioDiskCache:
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # video id -> file size, least recently used first
+        self.total_bytes = 0
+        self.indexes = {}  # video id -> Ogg page index, built on first seek into the file
+        self.populating = set()
+        self.semaphore = None
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.populated = 0
+        self.evictions = 0
+
+    # Blocking - called through asyncio.to_thread from setup_hook. Not done in __init__, because
+    # spawned worker processes re-import this module and would delete our in-progress downloads.
+    def start(self):
+        if self.enabled:
+            self._load()
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def path(self, video_id):
+        return os.path.join(self.directory, f"{video_id}.ogg")
+
+    # Pick up files from a previous run, oldest access first
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            full_path = os.path.join(self.directory, name)
+            if name.endswith(".part"):
+                # Interrupted download
+                try:
+                    os.remove(full_path)
+                except OSError:
+                    pass
+            elif name.endswith(".ogg"):
+                stat = os.stat(full_path)
+                files.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, video_id, size in sorted(files):
+            self.entries[video_id] = size
+            self.total_bytes += size
+        self._evict()
+        logger.info(f"Audio cache has {len(self.entries)} tracks ({self.total_bytes / 1048576:.1f} MB)")
+
+    def lookup(self, video_id):
+        if not self.enabled or video_id not in self.entries:
+            self.misses += 1
+            return None
+        path = self.path(video_id)
+        if not os.path.exists(path):
+            self._forget(video_id)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(video_id)
+        try:
+            os.utime(path)  # Keep LRU order across restarts
+        except OSError:
+            pass
+        self.hits += 1
+        return path
+
+    def page_index(self, video_id):
+        index = self.indexes.get(video_id)
+        if index is None:
+            index = build_ogg_index(self.path(video_id))
+            self.indexes[video_id] = index
+        return index
+
+    # Download and transcode a track in the background after it has been played.
+    # Returns whether the track is (or is about to be) cached.
+    def schedule_populate(self, video_id, stream_url, acodec=None):
+        if not self.enabled or not video_id or not CACHE_KEY_RE.match(video_id):
+            return False
+        if video_id in self.entries or video_id in self.populating:
+            return True
+        if acodec != "opus" and not get_ffmpeg().has_libopus:
+            return False
+        self.populating.add(video_id)
+        asyncio.create_task(self._populate(video_id, stream_url, acodec))
+        return True
+
+    async def _populate(self, video_id, stream_url, acodec):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(AUDIO_CACHE_WORKERS)
+        ffmpeg = get_ffmpeg()
+        path = self.path(video_id)
+        part_path = path + ".part"
+        # Opus sources are remuxed as-is, anything else is encoded once here
+        codec = ['-c:a', 'copy'] if acodec == "opus" else ['-c:a', 'libopus', '-b:a', f'{OPUS_BITRATE}k', '-ar', '48000', '-ac', '2']
+        try:
+            async with self.semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    ffmpeg.path,
+                    *ffmpeg.reconnect_args(),
+                    '-i', stream_url,
+                    '-loglevel', 'error',
+                    '-map_metadata', '-1',
+                    '-vn', *codec,
+                    '-f', 'ogg', '-y', part_path,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE
+                )
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                logger.warning(f"Caching {video_id} failed: {stderr.decode(errors='replace')[:500]}")
+                os.remove(part_path)
+                bot.loudness.schedule(video_id, stream_url)
+                return
+            os.replace(part_path, path)
+            size = os.path.getsize(path)
+            self.entries[video_id] = size
+            self.total_bytes += size
+            self.populated += 1
+            logger.info(f"Cached {video_id} on disk ({size / 1048576:.1f} MB)")
+            # Loudness is measured from the local copy; only a failed download goes back to the network
+            bot.loudness.schedule(video_id, path, local=True)
+            self._evict()
+        except Exception as e:
+            logger.error(f"Error caching {video_id}: {e}")
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+            bot.loudness.schedule(video_id, stream_url)
+        finally:
+            self.populating.discard(video_id)
+
+    def _forget(self, video_id):
+        size = self.entries.pop(video_id, 0)
+        self.total_bytes -= size
+        self.indexes.pop(video_id, None)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            video_id = next(iter(self.entries))
+            self._forget(video_id)
+            self.evictions += 1
+            try:
+                os.remove(self.path(video_id))
+            except OSError as e:
+                logger.warning(f"Could not remove cached file for {video_id}: {e}")
+
+    def stats(self):
+        return {
+            "tracks": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "populated": self.populated,
+            "evictions": self.evictions,
+        }
+
+LOUDNESS_RE = re.compile(r'I:\s+(-?[\d.]+) LUFS')
+PEAK_RE = re.compile(r'Peak:\s+(-?[\d.]+|-inf) dBFS')
+
+# EBU R128 loudness per video ID, measured once by a background ffmpeg pass the first time a track
+# plays and kept in the state database. Playback only ever applies the resulting constant gain;
+# a track's first play is left as it is.
+class LoudnessCache:
+    def __init__(self, store, target=LOUDNESS_TARGET, enabled=LOUDNESS_NORMALIZE):
+        self.store = store
+        self.target = target
+        self.enabled = enabled
+        self.levels = {}  # video id -> (integrated loudness in LUFS, sample peak in dBFS)
+        self.measuring = set()
+        self.semaphore = None
+        # Metrics
+        self.measured = 0
+        self.failures = 0
+
+    # Pick up levels measured by previous runs
+    async def load(self):
+        if not self.enabled:
+            return
+        try:
+            rows = await self.store.load_loudness()
+        except Exception as e:
+            logger.error(f"Error loading track loudness: {e}")
+            return
+        for video_id, integrated, peak in rows:
+            self.levels.setdefault(video_id, (integrated, peak))
+
+    # Linear gain for a track - 1.0 until it has been measured
+    def gain(self, video_id):
+        level = self.levels.get(video_id) if self.enabled and video_id else None
+        if level is None:
+            return 1.0
+        integrated, peak = level
+        # Never lift the loudest sample past full scale
+        gain_db = min(self.target - integrated, -peak, LOUDNESS_MAX_GAIN_DB)
+        gain_db = max(gain_db, -LOUDNESS_MAX_GAIN_DB)
+        if abs(gain_db) < LOUDNESS_TOLERANCE_DB:
+            return 1.0
+        return 10 ** (gain_db / 20)
+
+    def schedule(self, video_id, source, local=False):
+        if not self.enabled or not video_id or video_id in self.levels or video_id in self.measuring:
+            return
+        self.measuring.add(video_id)
+        asyncio.create_task(self._measure(video_id, source, local))
+
+    async def _measure(self, video_id, source, local):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(LOUDNESS_WORKERS)
+        ffmpeg = get_ffmpeg()
+        try:
+            async with self.semaphore:
+                # peak=sample moves the per-frame log to verbose, so stderr only carries the summary
+                process = await asyncio.create_subprocess_exec(
+                    ffmpeg.path,
+                    *([] if local else ffmpeg.reconnect_args()),
+                    '-hide_banner', '-nostats',
+                    '-i', source,
+                    '-vn',
+                    '-af', 'ebur128=peak=sample',
+                    '-f', 'null', '-',
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE
+                )
+                _, stderr = await process.communicate()
+            output = stderr.decode(errors='replace')
+            loudness = LOUDNESS_RE.findall(output)
+            peak = PEAK_RE.findall(output)
+            if process.returncode != 0 or not loudness:
+                logger.warning(f"Measuring loudness of {video_id} failed: {output[-500:]}")
+                self.failures += 1
+                return
+            integrated = float(loudness[-1])
+            peak_db = float(peak[-1]) if peak else 0.0
+            self.levels[video_id] = (integrated, peak_db)
+            self.measured += 1
+            logger.info(f"Measured {video_id} at {integrated:.1f} LUFS, peak {peak_db:.1f} dBFS (gain {self.gain(video_id):.2f})")
+            await self.store.save_loudness(video_id, integrated, peak_db)
+        except Exception as e:
+            logger.error(f"Error measuring loudness of {video_id}: {e}")
+            self.failures += 1
+        finally:
+            self.measuring.discard(video_id)
+
+    def stats(self):
+        return {
+            "tracks": len(self.levels),
+            "measuring": len(self.measuring),
+            "measured": self.measured,
+            "failures": self.failures,
+        }
+
+# Schedules Now Playing edits - at most one per message per interval, pending edits for the same
+# message are coalesced, and the interval backs off while Discord rate-limits us
+class UIUpdateScheduler:
+    def __init__(self, interval=UI_UPDATE_INTERVAL):
+        self.interval = interval
+        self.pending = OrderedDict()  # message id -> GuildPlayer, rendered when the edit is sent
+        self.next_allowed = {}  # message id -> loop time of the next routine edit
+        self.blocked_until = {}  # message id -> loop time a 429 told us to wait for
+        self.backoff = {}  # message id -> interval multiplier
+        self.last_sent = {}  # message id -> duration text of the last edit
+        self.wakeup = None
+        self.task = None
+        # Metrics
+        self.edits_sent = 0
+        self.edits_dropped = 0  # Edits that were due but never sent - unchanged text or rate-limited
+        self.requests_coalesced = 0  # Requests folded into an edit that was already pending
+        self.rate_limited = 0
+
+    # Ask for the player's message to be refreshed; urgent requests (state changes) skip the cadence
+    def request(self, player, urgent=False):
+        message = player.playing_message
+        if message is None:
+            return
+        if message.id in self.pending:
+            self.requests_coalesced += 1
+        self.pending[message.id] = player
+        if urgent:
+            self.next_allowed[message.id] = self.blocked_until.get(message.id, 0)
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
+
+    # Drop all state for a message that was deleted or replaced
+    def forget(self, message_id):
+        self.pending.pop(message_id, None)
+        self.next_allowed.pop(message_id, None)
+        self.blocked_until.pop(message_id, None)
+        self.backoff.pop(message_id, None)
+        self.last_sent.pop(message_id, None)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            now = loop.time()
+            for message_id in [m for m in self.pending if self.next_allowed.get(m, 0) <= now]:
+                player = self.pending.pop(message_id)
+                try:
+                    await self._send(message_id, player)
+                except Exception as e:
+                    logger.error(f"Error updating UI: {e}")
+
+            # Sleep until the next pending edit is due or a new request arrives
+            due = [self.next_allowed.get(m, 0) for m in self.pending]
+            timeout = max(0.0, min(due) - loop.time()) if due else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, message_id, player):
+        loop = asyncio.get_running_loop()
+        message = player.playing_message
+        if message is None or message.id != message_id:
+            self.forget(message_id)
+            return
+        text = f"{format_timestamp(player.current_timestamp)} / {format_timestamp(player.current_duration)}"
+        if self.last_sent.get(message_id) == text:
+            self.edits_dropped += 1  # Nothing visible changed
+            return
+
+        embed = message.embeds[0]
+        embed.set_field_at(0, name="Duration", value=text)
+        backoff = self.backoff.get(message_id, 1.0)
+        start = loop.time()
+        try:
+            await message.edit(embed=embed)
+        except discord.NotFound:
+            logger.warning(f"Playing message not found in guild {player.guild_id}, dropping UI updates")
+            self.forget(message_id)
+            return
+        except discord.HTTPException as e:
+            if e.status != 429:
+                raise
+            self.rate_limited += 1
+            self.edits_dropped += 1
+            retry_after = float(e.response.headers.get("Retry-After", self.interval))
+            self.blocked_until[message_id] = loop.time() + retry_after
+            self.backoff[message_id] = min(backoff * 2, UI_MAX_BACKOFF)
+            self.next_allowed[message_id] = self.blocked_until[message_id]
+            return
+
+        self.edits_sent += 1
+        self.last_sent[message_id] = text
+        # discord.py quietly waits out rate limits, so a slow edit means we're being throttled
+        if loop.time() - start > 1.0:
+            backoff = min(backoff * 2, UI_MAX_BACKOFF)
+        else:
+            backoff = max(1.0, backoff * 0.75)
+        self.backoff[message_id] = backoff
+        self.next_allowed[message_id] = loop.time() + self.interval * backoff
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "edits_sent": self.edits_sent,
+            "edits_dropped": self.edits_dropped,
+            "requests_coalesced": self.requests_coalesced,
+            "rate_limited": self.rate_limited,
+        }
+
+    def shutdown(self):
+        if self.task is not None:
+            self.task.cancel()
+
+# Collects ffmpeg's stderr on the event loop so the pipe never fills up and stalls ffmpeg
+class StderrDrain(asyncio.Protocol):
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.partial = b''
+
+    def data_received(self, data):
+        *lines, self.partial = (self.partial + data).split(b'\n')
+        for line in lines:
+            line = line.decode(errors='replace').strip()
+            if line:
+                logger.warning(f"ffmpeg [guild {self.guild_id}]: {line}")
+
+# Owns every ffmpeg process: spawns them per guild, drains stderr, and terminates/reaps
+# them in the background so callers never block waiting for an exit
+class ProcessSupervisor:
+    def __init__(self, terminate_timeout=3):
+        self.terminate_timeout = terminate_timeout
+        self.owned = {}  # guild id -> set of live Popen objects
+        # Metrics
+        self.spawned = 0
+        self.terminated = 0
+        self.killed = 0
+
+    def spawn(self, guild_id, command, **kwargs):
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **kwargs
+        )
+        self.owned.setdefault(guild_id, set()).add(process)
+        self.spawned += 1
+        asyncio.get_running_loop().create_task(self._drain_stderr(guild_id, process))
+        return process
+
+    async def _drain_stderr(self, guild_id, process):
+        try:
+            await asyncio.get_running_loop().connect_read_pipe(lambda: StderrDrain(guild_id), process.stderr)
+        except Exception:
+            # Event loops without pipe support (e.g. Windows proactor with anonymous pipes) - use a thread
+            drain = StderrDrain(guild_id)
+            def run():
+                for line in iter(process.stderr.readline, b''):
+                    drain.data_received(line)
+                process.stderr.close()
+            threading.Thread(target=run, name="ffmpeg-stderr", daemon=True).start()
+
+    # Ask a process to exit and return immediately; reaping happens in the background
+    def stop(self, process):
+        if process is None:
+            return
+        if process.poll() is None:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+        asyncio.get_running_loop().create_task(self._reap(process))
+
+    # Stop everything a guild owns (stop, eviction)
+    def stop_guild(self, guild_id):
+        for process in list(self.owned.get(guild_id, ())):
+            self.stop(process)
+
+    async def _reap(self, process):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.terminate_timeout
+        while process.poll() is None and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if process.poll() is None:
+            logger.warning(f"Process {process.pid} did not terminate in time, forcing kill")
+            self.killed += 1
+            if os.name == 'nt':  # Windows
+                await asyncio.create_subprocess_exec('taskkill', '/F', '/T', '/PID', str(process.pid))
+            else:  # Linux/Mac
+                process.kill()
+            while process.poll() is None:
+                await asyncio.sleep(0.05)
+        else:
+            self.terminated += 1
+        self._release(process)
+
+    def _release(self, process):
+        for guild_id, processes in list(self.owned.items()):
+            if process in processes:
+                processes.discard(process)
+                if not processes:
+                    del self.owned[guild_id]
+                break
+
+    # Forget processes that exited on their own (end of song)
+    def prune(self):
+        for processes in list(self.owned.values()):
+            for process in list(processes):
+                if process.poll() is not None:
+                    self._release(process)
+
+    def stats(self):
+        return {
+            "alive": sum(len(processes) for processes in self.owned.values()),
+            "guilds": len(self.owned),
+            "spawned": self.spawned,
+            "terminated": self.terminated,
+            "killed": self.killed,
+        }
+
+    # Last-resort synchronous kill on shutdown
+    def kill_all(self):
+        for processes in self.owned.values():
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+        self.owned.clear()
+
+# Decoders shared between guilds, keyed by video ID. Joining, detaching and closing can happen on the
+# voice threads, so the registry is guarded by a lock and hands process work back to the event loop.
+class SharedDecoders:
+    def __init__(self):
+        self.streams = {}  # video id -> [SharedPCMStream]
+        self.lock = threading.Lock()
+        self.loop = None
+        # Metrics
+        self.started = 0
+        self.joins = 0
+        self.detaches = 0
+
+    # Subscribe to a running decoder of this track that still has the frame for position buffered
+    def join(self, video_id, position, volume):
+        with self.lock:
+            candidates = list(self.streams.get(video_id, ()))
+        for stream in candidates:
+            subscriber = SharedPCMAudio(volume)
+            if stream.attach(subscriber, int(round((position - stream.start_position) / FRAME_DURATION))):
+                self.joins += 1
+                return subscriber
+        return None
+
+    # Wrap a freshly spawned ffmpeg in a new shared stream with one subscriber
+    def start(self, video_id, audio_input, local, process, position, volume):
+        self.loop = asyncio.get_running_loop()
+        stream = SharedPCMStream(self, video_id, audio_input, local, process, position)
+        subscriber = SharedPCMAudio(volume)
+        stream.attach(subscriber, 0)
+        with self.lock:
+            self.streams.setdefault(video_id, []).append(stream)
+        stream.start()
+        self.started += 1
+        return subscriber
+
+    # Called by a stream once its last subscriber is gone
+    def closed(self, stream):
+        with self.lock:
+            streams = self.streams.get(stream.video_id)
+            if streams and stream in streams:
+                streams.remove(stream)
+                if not streams:
+                    del self.streams[stream.video_id]
+        self._call(bot.processes.stop, stream.process)
+
+    # Called by a stream's reader thread when a subscriber fell too far behind to keep
+    def detached(self, subscriber, stream, position):
+        self.detaches += 1
+        self._call(lambda: asyncio.create_task(self._rebind(subscriber, stream, position)))
+
+    def _call(self, callback, *args):
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            pass  # Event loop already closed (shutdown)
+
+    # Move a detached subscriber onto another stream - an existing one if it covers the position,
+    # otherwise its own new decoder - without changing the AudioSource the voice client holds
+    async def _rebind(self, subscriber, old, position):
+        if subscriber.closed:
+            return
+        with self.lock:
+            candidates = list(self.streams.get(old.video_id, ()))
+        for stream in candidates:
+            if stream.attach(subscriber, int(round((position - stream.start_position) / FRAME_DURATION))):
+                self.joins += 1
+                return
+        try:
+            audio_input = old.audio_input
+            if not old.local:
+                track = bot.metadata_cache.get(old.video_id)
+                remaining = max(0, (track.duration or 0) - position) if track else 0
+                audio_input = await bot.metadata_cache.stream_url(old.video_id, remaining)
+            if subscriber.closed:
+                return
+            command = build_ffmpeg_command(get_ffmpeg(), audio_input, position, 1.0, local=old.local)
+            process = spawn_ffmpeg(SHARED_OWNER, command)
+        except Exception as e:
+            logger.error(f"Couldn't restart the decoder for {old.video_id} at {position:.1f}s: {e}")
+            subscriber.cleanup()
+            return
+        stream = SharedPCMStream(self, old.video_id, audio_input, old.local, process, position)
+        stream.attach(subscriber, 0)
+        with self.lock:
+            self.streams.setdefault(old.video_id, []).append(stream)
+        stream.start()
+        self.started += 1
+        # The subscriber may have been cleaned up while we were spawning
+        if subscriber.closed:
+            stream.remove(subscriber)
+
+    def stats(self):
+        with self.lock:
+            streams = [stream for streams in self.streams.values() for stream in streams]
+        return {
+            "streams": len(streams),
+            "subscribers": sum(len(stream.subscribers) for stream in streams),
+            "started": self.started,
+            "joins": self.joins,
+            "detached": self.detaches,
+        }
+
+# Bot-side end of one audio worker process: a duplex pipe plus a thread that routes
+# incoming Opus packets to the WorkerAudio source of each job
+class AudioWorkerHandle:
+    def __init__(self, context, index, on_lost):
+        self.index = index
+        self.on_lost = on_lost
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=audio_worker_main, args=(child,), name=f"audio-worker-{index}", daemon=True)
+        self.process.start()
+        child.close()
+        self.send_lock = threading.Lock()
+        self.sources = {}  # job id -> WorkerAudio
+        self.alive = False
+
+    # Wait for the worker to load libopus; returns whether it can take jobs
+    def handshake(self, timeout=30):
+        try:
+            if self.conn.poll(timeout):
+                kind, ok = self.conn.recv()
+                self.alive = kind == "ready" and ok
+        except (OSError, EOFError):
+            # Died during startup
+            self.alive = False
+        if not self.alive:
+            self.stop()
+            return False
+        threading.Thread(target=self._receive, name=f"audio-worker-{self.index}-rx", daemon=True).start()
+        return True
+
+    def send(self, message):
+        try:
+            with self.send_lock:
+                self.conn.send(message)
+        except (OSError, EOFError, ValueError):
+            self._lost()
+
+    def _receive(self):
+        try:
+            while True:
+                kind, job_id, *payload = self.conn.recv()
+                source = self.sources.get(job_id)
+                if source is None:
+                    continue
+                if kind == "frames":
+                    source.deliver(payload[0])
+                elif kind == "eof":
+                    source.finish()
+        except (OSError, EOFError):
+            pass
+        self._lost()
+
+    # The worker died - its streams play silence until their guilds are restarted at the same position
+    def _lost(self):
+        if not self.alive:
+            return
+        self.alive = False
+        logger.error(f"Audio worker {self.index} exited with {len(self.sources)} active streams")
+        sources = list(self.sources.values())
+        for source in sources:
+            source.lose()
+        self.on_lost(self, sources)
+
+    def stop(self):
+        self.alive = False
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.kill()
+
+# Local worker processes that run ffmpeg, apply volume and encode Opus, so per-frame audio work
+# scales across cores instead of competing with the gateway for one GIL. Voice sends stay here -
+# discord.py's voice client is tied to this process's gateway session - but they only move
+# ready-made Opus packets. Jobs go to the worker with the fewest active streams.
+class AudioWorkerPool:
+    def __init__(self, workers=AUDIO_WORKERS, on_streams_lost=None):
+        self.size = max(0, workers)
+        self.on_streams_lost = on_streams_lost  # Called from a worker thread with the sources of a dead worker
+        self.workers = []
+        self.job_ids = itertools.count(1)
+        self.context = multiprocessing.get_context("spawn")
+        # Metrics
+        self.jobs = 0
+        self.restarts = 0
+
+    @property
+    def enabled(self):
+        return any(worker.alive for worker in self.workers)
+
+    # Blocking - called through asyncio.to_thread from setup_hook
+    def start(self):
+        if not self.size:
+            return
+        self.workers = [AudioWorkerHandle(self.context, index, self._replace) for index in range(self.size)]
+        ready = sum(worker.handshake() for worker in self.workers)
+        if ready:
+            logger.info(f"Started {ready} audio worker processes")
+        else:
+            logger.warning("Audio workers couldn't load libopus; decoding in the bot process instead")
+            self.shutdown()
+
+    # Hand a dead worker's streams back for recovery and restart the worker in the background
+    def _replace(self, dead, sources):
+        if sources and self.on_streams_lost is not None:
+            self.on_streams_lost(sources)
+        def run():
+            # Reap the old process and close its pipe before the replacement takes its slot
+            dead.stop()
+            try:
+                worker = AudioWorkerHandle(self.context, dead.index, self._replace)
+            except Exception as e:
+                logger.error(f"Couldn't restart audio worker {dead.index}: {e}")
+                return
+            if worker.handshake():
+                self.workers[dead.index] = worker
+                self.restarts += 1
+            else:
+                logger.error(f"Restarted audio worker {dead.index} didn't come up")
+        threading.Thread(target=run, name="audio-worker-restart", daemon=True).start()
+
+    # Start decoding command in the least busy worker; None when no worker is available
+    def open(self, command, volume, start_position):
+        workers = [worker for worker in self.workers if worker.alive]
+        if not workers:
+            return None
+        worker = min(workers, key=lambda w: len(w.sources))
+        job_id = next(self.job_ids)
+        source = WorkerAudio(worker, job_id, volume, start_position)
+        worker.sources[job_id] = source
+        worker.send(("start", job_id, command, volume, source.readahead_frames, OPUS_BITRATE, WORKER_BATCH_FRAMES))
+        self.jobs += 1
+        return source
+
+    def stats(self):
+        return {
+            "workers": sum(worker.alive for worker in self.workers),
+            "streams": sum(len(worker.sources) for worker in self.workers),
+            "jobs": self.jobs,
+            "restarts": self.restarts,
+        }
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id INTEGER PRIMARY KEY,
+    voice_channel_id INTEGER NOT NULL,
+    text_channel_id INTEGER,
+    video_id TEXT,
+    title TEXT,
+    duration REAL,
+    position REAL,
+    volume INTEGER,
+    saved_at REAL
+);
+CREATE TABLE IF NOT EXISTS queue_entries (
+    guild_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    video_id TEXT NOT NULL,
+    title TEXT,
+    duration REAL,
+    PRIMARY KEY (guild_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS track_loudness (
+    video_id TEXT PRIMARY KEY,
+    integrated REAL NOT NULL,
+    peak REAL NOT NULL,
+    measured_at REAL
+) WITHOUT ROWID;
+"""
+
+# Snapshots every guild's queue, current track and position to SQLite so a restart can resume playback.
+# The event loop only diffs player state against the last snapshot; the writes themselves are batched
+# into one transaction per flush on a dedicated thread.
+class StateStore:
+    def __init__(self, path=STATE_DB_PATH, interval=STATE_FLUSH_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.db = None  # Only touched from the executor thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state") if path else None
+        self.saved = {}  # guild id -> (player, queue version, guild row) as last written
+        self.task = None
+        # Metrics
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.last_flush_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _open(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(STATE_SCHEMA)
+        return self.db
+
+    # Read the previous run's state - returns (guild rows, guild id -> [(video_id, title, duration)]).
+    # Only guilds accepted by owns() are returned and managed by this process; rows belonging to
+    # shards run by other processes sharing the database are left alone.
+    async def load(self, owns=lambda guild_id: True):
+        if not self.enabled:
+            return [], {}
+        loop = asyncio.get_running_loop()
+        guilds, queues = await loop.run_in_executor(self.executor, self._load)
+        guilds = [row for row in guilds if owns(row[0])]
+        queues = {guild_id: entries for guild_id, entries in queues.items() if owns(guild_id)}
+        # Rows we don't restore get deleted by the first flush
+        for row in guilds:
+            self.saved[row[0]] = (None, None, None)
+        return guilds, queues
+
+    def _load(self):
+        db = self._open()
+        guilds = db.execute(
+            "SELECT guild_id, voice_channel_id, text_channel_id, video_id, title, duration, position, volume FROM guilds"
+        ).fetchall()
+        queues = {}
+        for guild_id, video_id, title, duration in db.execute(
+            "SELECT guild_id, video_id, title, duration FROM queue_entries ORDER BY guild_id, position"
+        ):
+            queues.setdefault(guild_id, []).append((video_id, title, duration))
+        return guilds, queues
+
+    # Loudness measured by previous runs - [(video_id, integrated LUFS, peak dBFS)]
+    async def load_loudness(self):
+        if not self.enabled:
+            return []
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: self._open().execute(
+            "SELECT video_id, integrated, peak FROM track_loudness"
+        ).fetchall())
+
+    async def save_loudness(self, video_id, integrated, peak):
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._save_loudness, video_id, integrated, peak)
+
+    def _save_loudness(self, video_id, integrated, peak):
+        db = self._open()
+        with db:
+            db.execute("INSERT OR REPLACE INTO track_loudness VALUES (?, ?, ?, ?)", (video_id, integrated, peak, time.time()))
+
+    def start(self, bot):
+        if self.enabled and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run(bot))
+
+    async def _run(self, bot):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush(bot.players.values())
+
+    # Work out what changed since the last flush; cheap enough to run on the event loop
+    def _snapshot(self, players):
+        guild_rows, queues = [], []
+        live = set()
+        for player in players:
+            if player.reconnect_voice:
+                # Mid-reconnect or mid-restore - keep whatever was saved last
+                live.add(player.guild_id)
+                continue
+            guild = player.bot.get_guild(player.guild_id)
+            vc = guild.voice_client if guild else None
+            if vc is None or not vc.is_connected() or not (player.current_video_id or player.queue):
+                continue
+            live.add(player.guild_id)
+
+            track = player.bot.metadata_cache.get(player.current_video_id) if player.current_video_id else None
+            row = (
+                player.guild_id,
+                vc.channel.id,
+                player.playing_message.channel.id if player.playing_message else None,
+                player.current_video_id,
+                track.title if track else None,
+                player.current_duration,
+                round(player.current_timestamp, 1),
+                player.volume,
+            )
+            last_player, last_version, last_row = self.saved.get(player.guild_id, (None, None, None))
+            if row != last_row:
+                guild_rows.append(row)
+            if last_player is not player or last_version != player.queue.version:
+                queues.append((player.guild_id, [
+                    (player.guild_id, i, entry.video_id, entry.title, entry.duration)
+                    for i, entry in enumerate(player.queue)
+                ]))
+            self.saved[player.guild_id] = (player, player.queue.version, row)
+
+        deleted = [guild_id for guild_id in self.saved if guild_id not in live]
+        for guild_id in deleted:
+            del self.saved[guild_id]
+        return guild_rows, queues, deleted
+
+    async def flush(self, players):
+        if not self.enabled:
+            return
+        guild_rows, queues, deleted = self._snapshot(players)
+        if not (guild_rows or queues or deleted):
+            return
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            await loop.run_in_executor(self.executor, self._write, guild_rows, queues, deleted)
+        except Exception as e:
+            logger.error(f"Error saving player state: {e}")
+            self.errors += 1
+            self.saved.clear()  # Rewrite everything on the next flush
+            return
+        self.flushes += 1
+        self.rows_written += len(guild_rows) + sum(len(rows) for _, rows in queues)
+        self.last_flush_seconds = loop.time() - start
+
+    def _write(self, guild_rows, queues, deleted):
+        db = self._open()
+        now = time.time()
+        with db:
+            db.executemany("DELETE FROM guilds WHERE guild_id = ?", [(guild_id,) for guild_id in deleted])
+            db.executemany("DELETE FROM queue_entries WHERE guild_id = ?", [(guild_id,) for guild_id in deleted])
+            db.executemany(
+                "INSERT OR REPLACE INTO guilds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [row + (now,) for row in guild_rows]
+            )
+            for guild_id, rows in queues:
+                db.execute("DELETE FROM queue_entries WHERE guild_id = ?", (guild_id,))
+                db.executemany("INSERT INTO queue_entries VALUES (?, ?, ?, ?, ?)", rows)
+
+    def stats(self):
+        return {
+            "guilds_saved": len(self.saved),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "errors": self.errors,
+            "last_flush_seconds": round(self.last_flush_seconds, 4),
+        }
+
+    # Write the final snapshot and stop the writer thread
+    async def shutdown(self, players):
+        if not self.enabled:
+            return
+        if self.task is not None:
+            self.task.cancel()
+        await self.flush(players)
+        self.executor.shutdown(wait=True)
+
+# A queued track - compact record with a stable ID so commands never match the wrong duplicate
+class QueueEntry:
+    __slots__ = ("entry_id", "video_id", "title", "duration")
+
+    def __init__(self, entry_id, video_id, title, duration):
+        self.entry_id = entry_id
+        self.video_id = video_id
+        self.title = title
+        self.duration = duration
+
+# Positional song queue backed by a flat list with a moving head: indexing and popleft are O(1),
+# inserts/removes are a single C-level memmove, and the remaining duration is kept up to date
+class TrackQueue:
+    def __init__(self):
+        self._items = []
+        self._head = 0  # Items before this index have already been popped
+        self._by_id = {}
+        self._next_id = 1
+        self.total_duration = 0
+        self.version = 0  # Bumped on every change so views can tell when to re-render
+
+    def __len__(self):
+        return len(self._items) - self._head
+
+    def __bool__(self):
+        return len(self._items) > self._head
+
+    def __iter__(self):
+        return iter(self._items[self._head:])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return self._items[self._head + start:self._head + stop:step]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("queue index out of range")
+        return self._items[self._head + index]
+
+    def _new_entry(self, video_id, title, duration):
+        entry = QueueEntry(self._next_id, video_id, title, duration or 0)
+        self._next_id += 1
+        self._by_id[entry.entry_id] = entry
+        self.total_duration += entry.duration
+        return entry
+
+    def _changed(self):
+        self.version += 1
+
+    def get(self, entry_id):
+        return self._by_id.get(entry_id)
+
+    def peek(self):
+        return self._items[self._head] if self else None
+
+    def append(self, video_id, title, duration):
+        entry = self._new_entry(video_id, title, duration)
+        self._items.append(entry)
+        self._changed()
+        return entry
+
+    def extend(self, tracks):
+        entries = [self._new_entry(video_id, title, duration) for video_id, title, duration in tracks]
+        self._items.extend(entries)
+        self._changed()
+        return entries
+
+    # Queue a track to play right after the current one
+    def insert_next(self, video_id, title, duration):
+        entry = self._new_entry(video_id, title, duration)
+        if self._head > 0:
+            # Reuse the slot freed by the last popleft - no shifting needed
+            self._head -= 1
+            self._items[self._head] = entry
+        else:
+            self._items.insert(0, entry)
+        self._changed()
+        return entry
+
+    def popleft(self):
+        if not self:
+            raise IndexError("pop from an empty queue")
+        entry = self._items[self._head]
+        self._items[self._head] = None
+        self._head += 1
+        # Compact once the dead prefix dominates, keeping popleft amortised O(1)
+        if self._head > 64 and self._head * 2 > len(self._items):
+            del self._items[:self._head]
+            self._head = 0
+        self._forget(entry)
+        self._changed()
+        return entry
+
+    def _forget(self, entry):
+        del self._by_id[entry.entry_id]
+        self.total_duration -= entry.duration
+
+    def remove_at(self, index):
+        entry = self[index]
+        del self._items[self._head + (index if index >= 0 else index + len(self))]
+        self._forget(entry)
+        self._changed()
+        return entry
+
+    def move(self, from_index, to_index):
+        entry = self.remove_at(from_index)
+        # Re-register the same entry (same ID) at its new position
+        self._by_id[entry.entry_id] = entry
+        self.total_duration += entry.duration
+        self._items.insert(self._head + max(0, min(to_index, len(self))), entry)
+        self._changed()
+        return entry
+
+    def shuffle(self):
+        live = self._items[self._head:]
+        random.shuffle(live)
+        self._items = live
+        self._head = 0
+        self._changed()
+
+    def clear(self):
+        self._items = []
+        self._head = 0
+        self._by_id.clear()
+        self.total_duration = 0
+        self._changed()
+
+# Formatted /queue pages, memoised until the queue changes so paging never re-renders the whole queue
+class QueuePages:
+    def __init__(self, queue):
+        self.queue = queue
+        self._pages = {}
+        self._version = queue.version
+
+    def page_count(self):
+        return max(1, -(-len(self.queue) // QUEUE_PAGE_SIZE))
+
+    def page(self, index):
+        if self._version != self.queue.version:
+            self._pages.clear()
+            self._version = self.queue.version
+        text = self._pages.get(index)
+        if text is None:
+            start = index * QUEUE_PAGE_SIZE
+            lines = []
+            for i, entry in enumerate(self.queue[start:start + QUEUE_PAGE_SIZE], start + 1):
+                title = entry.title
+                if len(title) > QUEUE_TITLE_LENGTH:
+                    title = title[:QUEUE_TITLE_LENGTH - 1] + "…"
+                lines.append(f"{i}. **{title}** ({format_timestamp(entry.duration)})")
+            text = "\n".join(lines) or "No songs in queue"
+            self._pages[index] = text
+        return text
+
+# Per-guild player state - every guild gets its own queue, ffmpeg process, timers and UI message
+class GuildPlayer:
+    def __init__(self, bot, guild_id):
+        self.bot = bot
+        self.guild_id = guild_id
+        self.queue = TrackQueue()
+        self.queue_pages = QueuePages(self.queue)
+        self.current_song = None
+        self.current_video_id = None
+        self.current_duration = 0
+        self._timestamp = 0  # Position pinned while no source is driving the clock
+        self.clock_source = None  # Audio source whose sent frames define the position
+        self.playing_message = None
+        self.is_paused = False
+        self.volume = 100  # Default volume (0-100)
+        self.seeking = False  # Flag to prevent multiple seek operations at once
+        self.current_process = None  # Track the current ffmpeg process
+        self.current_source = None  # The current track's AudioSource
+        self.audio_chain = None  # GaplessAudio wrapper actually handed to the voice client
+        self.prefetched = None  # PrefetchedTrack for the head of the queue, if its decoder is already running
+        self.prefetch_task = None
+        self.prefetch_failed = None  # Queue entry that couldn't be resolved ahead of time - not retried until it is played
+        self.process_start_time = 0  # Track when the process started
+        self.reconnect_voice = False
+        self.voice_reconnect_task = None
+        # Heartbeat bookkeeping - the last frame count seen and when it last moved
+        self.health_source = None
+        self.health_frames = 0
+        self.health_since = 0
+        self.health_underruns = 0
+        # Each guild runs its own UI update loop
+        self.update_ui = tasks.loop(seconds=1)(self._update_ui)
+        self.update_ui.before_loop(self._before_update_ui)
+
+    # Update UI Task - with improved error handling
+    async def _update_ui(self, vc, interaction):
+        try:
+            if vc.is_playing() and not self.is_paused and not self.seeking:
+                # Warm up the next track's decoder during the last few seconds
+                if (self.queue and self.prefetched is None and self.current_duration
+                        and self.current_duration - self.current_timestamp <= PREFETCH_SECONDS
+                        and (self.prefetch_task is None or self.prefetch_task.done())
+                        and self.queue.peek() is not self.prefetch_failed):
+                    self.prefetch_task = asyncio.create_task(prefetch_next(self))
+
+                # The scheduler decides when the edit actually goes out
+                self.bot.ui_scheduler.request(self)
+            elif self.is_paused or self.seeking:
+                # Nothing to refresh while paused or seeking
+                pass
+            else:
+                if not vc.is_connected():
+                    logger.warning(f"Voice client disconnected in guild {self.guild_id}, stopping UI updates")
+                    self.update_ui.stop()
+        except Exception as e:
+            logger.error(f"Exception in update_ui task: {e}")
+            # Don't stop the task for general errors
+
+    async def _before_update_ui(self):
+        await self.bot.wait_until_ready()
+
+    # Playback position in seconds, derived from the frames the audio source has actually handed out
+    @property
+    def current_timestamp(self):
+        source = self.clock_source
+        if source is None:
+            return self._timestamp
+        position = source.position
+        if self.current_duration:
+            position = min(position, self.current_duration)
+        return position
+
+    # Pin the position (new song, reconnect) until the next source starts playing
+    @current_timestamp.setter
+    def current_timestamp(self, value):
+        self._timestamp = value
+        self.clock_source = None
+
+    # Reset playback state after a stop or disconnect
+    def reset(self):
+        self.update_ui.cancel()
+        discard_prefetch(self)
+        cleanup_processes(self)
+        self.bot.processes.stop_guild(self.guild_id)
+        self.queue.clear()
+        self.current_song = None
+        self.current_video_id = None
+        self.current_timestamp = 0
+        self.is_paused = False
+        self.seeking = False
+        self.current_process = None
+        self.current_source = None
+        self.audio_chain = None
+
+# Parse a shard list like "0-3,8" into [0, 1, 2, 3, 8]
+def parse_shard_ids(spec):
+    shard_ids = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(shard_ids))
+
+# Constructor arguments for AutoShardedBot; None lets discord.py ask Discord for the shard count
+def shard_options():
+    return {
+        "shard_count": None if SHARD_COUNT in ("", "auto") else int(SHARD_COUNT),
+        "shard_ids": parse_shard_ids(SHARD_IDS) or None,
+    }
+
+SHARDED = bool(SHARD_COUNT or SHARD_IDS)
+
+# Health checks for the players on one shard. Each shard runs its own loop over only the guilds
+# it owns, so a pass costs the same however many other shards share the process.
+class ShardHealth:
+    def __init__(self, bot, shard_id):
+        self.bot = bot
+        self.shard_id = shard_id
+        self.players = {}  # guild id -> GuildPlayer for guilds on this shard
+        self.passes = 0
+        self.last_pass_seconds = 0.0
+        self.check = tasks.loop(seconds=HEARTBEAT_INTERVAL)(self._check)
+
+    # One cheap pass over the shard's players, no blocking calls on the event loop
+    async def _check(self):
+        start = time.perf_counter()
+        now = time.time()
+        for player in list(self.players.values()):
+            guild = self.bot.get_guild(player.guild_id)
+            if guild is None:
+                # We were removed from the guild - drop its state
+                self.bot.evict_player(player.guild_id)
+                continue
+
+            # Drop idle players so memory stays proportional to active guilds
+            if not guild.voice_client and not player.current_song and not player.queue and not player.reconnect_voice:
+                self.bot.evict_player(player.guild_id)
+                continue
+
+            try:
+                self.bot.check_player_health(player, guild, now)
+            except Exception as e:
+                logger.error(f"Error checking playback health in guild {guild.id}: {e}")
+        self.passes += 1
+        self.last_pass_seconds = time.perf_counter() - start
+
+# Bot Setup - MUSICBOT_SHARD_COUNT / MUSICBOT_SHARD_IDS switch to one gateway connection per shard
+class MusicBot(commands.AutoShardedBot if SHARDED else commands.Bot):
+    def __init__(self):
+        super().__init__(command_prefix="!", intents=intents, **(shard_options() if SHARDED else {}))
+        self.players = {}  # guild id -> GuildPlayer
+        self.shard_health = {}  # shard id -> ShardHealth
+        self.heartbeat_task = None
+        self.extraction_pool = ExtractionPool()
+        self.metadata_cache = MetadataCache(self.extraction_pool)
+        self.audio_cache = AudioDiskCache()
+        self.ui_scheduler = UIUpdateScheduler()
+        self.processes = ProcessSupervisor()
+        self.shared_decoders = SharedDecoders()
+        self.audio_workers = AudioWorkerPool(on_streams_lost=self.recover_worker_streams)
+        self.state_store = StateStore()
+        self.loudness = LoudnessCache(self.state_store)
+        self.ffmpeg = None  # FFmpegCapabilities
+        self.setup_seconds = None
+        self.ready_seconds = None  # Process start to first on_ready
+
+    async def setup_hook(self):
+        start = time.perf_counter()
+        # Resolve the ffmpeg binary and its features off the event loop while the command tree is checked
+        self.ffmpeg, _, _, _ = await asyncio.gather(
+            asyncio.to_thread(FFmpegCapabilities.probe),
+            self.sync_commands(),
+            asyncio.to_thread(self.audio_workers.start),
+            asyncio.to_thread(self.audio_cache.start),
+        )
+        self.setup_seconds = time.perf_counter() - start
+        # Start voice connection health check
+        self.heartbeat_task = self.heartbeat.start()
+        await metrics.start(self)
+        self.loop.create_task(self.loudness.load())
+        # Pick up where the previous run left off once the guild cache is ready
+        self.loop.create_task(self.restore_players())
+
+    # Push slash commands to Discord only when their definitions changed since the last sync.
+    # tree.sync() is a rate-limited global call, so skipping it is most of a restart's setup time.
+    async def sync_commands(self):
+        payload = sorted((command.to_dict(self.tree) for command in self.tree.get_commands()), key=lambda c: (c["type"], c["name"]))
+        digest = hashlib.sha256(json.dumps([self.application_id, payload], sort_keys=True).encode()).hexdigest()
+        if COMMAND_HASH_FILE:
+            try:
+                with open(COMMAND_HASH_FILE) as f:
+                    if f.read().strip() == digest:
+                        logger.info("Command tree unchanged, skipping sync")
+                        return
+            except OSError:
+                pass
+
+        commands_synced = await self.tree.sync()
+        logger.info(f"Synced {len(commands_synced)} commands")
+        if COMMAND_HASH_FILE:
+            try:
+                with open(COMMAND_HASH_FILE, "w") as f:
+                    f.write(digest)
+            except OSError as e:
+                logger.warning(f"Couldn't save command tree hash: {e}")
+
+    async def close(self):
+        for health in self.shard_health.values():
+            health.check.cancel()
+        await self.state_store.shutdown(list(self.players.values()))
+        await metrics.shutdown()
+        self.ui_scheduler.shutdown()
+        self.extraction_pool.shutdown()
+        self.processes.kill_all()
+        self.audio_workers.shutdown()
+        await super().close()
+
+    # Counters kept by each component, keyed by the prefix they are exported under
+    def component_stats(self):
+        return {
+            "extraction": self.extraction_pool.stats(),
+            "metadata_cache": self.metadata_cache.stats(),
+            "audio_cache": self.audio_cache.stats(),
+            "ui": self.ui_scheduler.stats(),
+            "ffmpeg": self.processes.stats(),
+            "shared_decode": self.shared_decoders.stats(),
+            "audio_workers": self.audio_workers.stats(),
+            "state_store": self.state_store.stats(),
+            "loudness": self.loudness.stats(),
+        }
+
+    # Get the player for a guild, creating it on first use
+    def get_player(self, guild):
+        player = self.players.get(guild.id)
+        if player is None:
+            player = GuildPlayer(self, guild.id)
+            self.players[guild.id] = player
+            self.get_shard_health(self.shard_of(guild.id)).players[guild.id] = player
+        return player
+
+    # Shards whose gateway connection runs in this process
+    def local_shard_ids(self):
+        if SHARDED:
+            return sorted(self.shards)
+        return [self.shard_id or 0]
+
+    # Same formula Discord uses to assign guilds to shards
+    def shard_of(self, guild_id):
+        return (guild_id >> 22) % self.shard_count if self.shard_count else 0
+
+    def get_shard_health(self, shard_id):
+        health = self.shard_health.get(shard_id)
+        if health is None:
+            health = ShardHealth(self, shard_id)
+            self.shard_health[shard_id] = health
+        return health
+
+    # Heartbeat latency of one shard's gateway connection, None before its first heartbeat
+    def shard_latency(self, shard_id):
+        if SHARDED:
+            shard = self.get_shard(shard_id)
+            latency = shard.latency if shard else float("nan")
+        else:
+            latency = self.latency
+        return latency if latency == latency else None  # NaN until the first heartbeat ACK
+
+    # Per-shard numbers for /stats and the metrics endpoint
+    def shard_stats(self):
+        guilds = {}
+        for guild in self.guilds:
+            guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+        stats = {}
+        for shard_id in self.local_shard_ids():
+            health = self.shard_health.get(shard_id)
+            stats[shard_id] = {
+                "latency_seconds": self.shard_latency(shard_id),
+                "guilds": guilds.get(shard_id, 0),
+                "players": len(health.players) if health else 0,
+                "heartbeat_seconds": health.last_pass_seconds if health else 0.0,
+            }
+        return stats
+
+    # Rejoin voice and resume every guild saved by the previous run
+    async def restore_players(self):
+        await self.wait_until_ready()
+        start = time.perf_counter()
+        local_shards = set(self.local_shard_ids())
+        try:
+            guilds, queues = await self.state_store.load(lambda guild_id: self.shard_of(guild_id) in local_shards)
+        except Exception as e:
+            logger.error(f"Error loading saved player state: {e}")
+            guilds, queues = [], {}
+
+        restored = 0
+        for guild_id, voice_channel_id, text_channel_id, video_id, title, duration, position, volume in guilds:
+            guild = self.get_guild(guild_id)
+            channel = guild.get_channel(voice_channel_id) if guild else None
+            if channel is None:
+                continue
+            player = self.get_player(guild)
+            player.queue.extend(queues.get(guild_id, ()))
+            player.volume = volume if volume is not None else 100
+            player.current_video_id = video_id
+            player.current_duration = duration or 0
+            player.current_timestamp = position or 0
+            # Keeps the heartbeat and the state store away until playback is back
+            player.reconnect_voice = True
+            text_channel = guild.get_channel(text_channel_id) if text_channel_id else None
+            player.voice_reconnect_task = self.loop.create_task(resume_player(player, guild, channel, text_channel, title))
+            restored += 1
+
+        self.state_store.start(self)
+        if guilds:
+            logger.info(f"Restored {restored}/{len(guilds)} saved players ({sum(len(q) for q in queues.values())} queued songs) in {time.perf_counter() - start:.2f}s")
+
+    # Drop a guild's player and release its ffmpeg process and timers
+    def evict_player(self, guild_id):
+        player = self.players.pop(guild_id, None)
+        health = self.shard_health.get(self.shard_of(guild_id))
+        if health:
+            health.players.pop(guild_id, None)
+        if player:
+            player.reset()
+            logger.info(f"Evicted player for guild {guild_id}")
+
+    # Heartbeat - process-wide housekeeping; player health is checked per shard by ShardHealth
+    @tasks.loop(seconds=HEARTBEAT_INTERVAL)  # Increased frequency from 30 to 10 seconds
+    async def heartbeat(self):
+        self.processes.prune()
+        read_delays.flush()
+
+    # Judge playback health from the audio source's frame counter and buffer fill instead of CPU sampling
+    def check_player_health(self, player, guild, now):
+        vc = guild.voice_client
+        if not vc or not vc.is_connected() or player.reconnect_voice:
+            return
+
+        source = player.current_source
+
+        # If we're not playing and not paused, but have a current song, something might be wrong
+        if not vc.is_playing() and not player.is_paused and not player.seeking and player.current_song:
+            # The source never ran out, so the song didn't finish - whether it is fed by our own ffmpeg,
+            # a shared decoder, a worker process or a cached file
+            if source is not None and not source.ended:
+                # Give song changes a moment before calling it a stall
+                if now - player.process_start_time > 3:  # Reduced from 5 to 3 seconds
+                    self.recover_playback(player, guild, "voice client stopped before the song ended")
+            return
+
+        if not vc.is_playing() or player.is_paused or player.seeking or source is None:
+            player.health_source = None
+            return
+
+        # Frames handed to the voice client must keep moving while we're playing
+        frames = source.frames_played
+        if source is not player.health_source or frames != player.health_frames:
+            player.health_source = source
+            player.health_frames = frames
+            player.health_since = now
+        elif now - player.health_since > STALL_SECONDS:
+            self.recover_playback(player, guild, f"no audio frames sent for {now - player.health_since:.0f}s")
+            return
+
+        # Report new underruns and a drained read-ahead so jitter problems show up before a stall
+        if isinstance(source, PCM_SOURCES):
+            if source.underruns > player.health_underruns:
+                logger.warning(f"{source.underruns - player.health_underruns} audio underruns in guild {guild.id} (buffer {source.fill_level * FRAME_DURATION:.2f}s)")
+            player.health_underruns = source.underruns
+
+    # A worker process died - restart its guilds at their current position instead of letting
+    # the queue skip ahead. Called from the worker's receiver thread.
+    def recover_worker_streams(self, sources):
+        self.loop.call_soon_threadsafe(self._recover_worker_streams, set(map(id, sources)))
+
+    def _recover_worker_streams(self, source_ids):
+        for player in list(self.players.values()):
+            if player.prefetched is not None and id(player.prefetched.source) in source_ids:
+                discard_prefetch(player)
+            if id(player.current_source) not in source_ids or player.reconnect_voice:
+                continue
+            guild = self.get_guild(player.guild_id)
+            if guild is not None and guild.voice_client is not None:
+                self.recover_playback(player, guild, "audio worker exited")
+
+    # Restart playback from the current position through a voice reconnect
+    def recover_playback(self, player, guild, reason):
+        metrics.recoveries.inc()
+        logger.warning(f"Heartbeat detected stalled playback in guild {guild.id} at {player.current_timestamp:.1f}s ({reason}), attempting recovery")
+        player.reconnect_voice = True
+        current_position = player.current_timestamp
+
+        # Clean up the existing process
+        cleanup_processes(player)
+
+        # Schedule reconnection
+        if not player.voice_reconnect_task or player.voice_reconnect_task.done():
+            player.voice_reconnect_task = self.loop.create_task(
+                reconnect_voice_client(guild, guild.voice_client.channel, current_position)
+            )
+
+    @heartbeat.before_loop
+    async def before_heartbeat(self):
+        await self.wait_until_ready()
+        # Every shard is connected once we're ready, so the local shard ids are known (even with "auto")
+        for shard_id in self.local_shard_ids():
+            self.get_shard_health(shard_id).check.start()
+
+bot = MusicBot()
+
+# Helper function to locate the ffmpeg binary (no subprocess - shutil.which searches PATH directly)
+def find_ffmpeg():
+    if os.name == 'nt':  # Windows
+        ffmpeg_path = os.path.join(os.path.dirname(__file__), "ffmpeg", "ffmpeg.exe")
+        if not os.path.exists(ffmpeg_path):
+            # Try system path
+            ffmpeg_path = "ffmpeg"
+    else:  # Linux/Mac
+        # Try using system ffmpeg first
+        if shutil.which('ffmpeg'):
+            ffmpeg_path = 'ffmpeg'
+        else:
+            ffmpeg_path = os.path.join(os.path.dirname(__file__), "ffmpeg", "ffmpeg")
+    return ffmpeg_path
+
+# What the installed ffmpeg can do - probed once at startup so the playback path never forks to find out
+class FFmpegCapabilities:
+    RECONNECT_OPTIONS = ('reconnect', 'reconnect_streamed', 'reconnect_delay_max')
+
+    def __init__(self, path, version=None, protocols=None, encoders=None, http_options=None):
+        self.path = path
+        self.version = version
+        self.protocols = protocols  # None means "not probed" - assume supported
+        self.encoders = encoders
+        self.http_options = http_options
+
+    @property
+    def has_libopus(self):
+        return self.encoders is None or 'libopus' in self.encoders
+
+    @property
+    def supports_https(self):
+        return self.protocols is None or 'https' in self.protocols
+
+    @property
+    def supports_reconnect(self):
+        return self.http_options is None or all(option in self.http_options for option in self.RECONNECT_OPTIONS)
+
+    # Input options that let ffmpeg ride out dropped HTTP connections, when the binary has them
+    def reconnect_args(self):
+        if not self.supports_reconnect:
+            return []
+        return ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+
+    @classmethod
+    def probe(cls):
+        path = find_ffmpeg()
+
+        def run(*args):
+            return subprocess.run([path, '-hide_banner', *args], capture_output=True, text=True, timeout=10).stdout
+
+        try:
+            version = run('-version').splitlines()[0]
+
+            # "-protocols" lists input protocols, then output protocols
+            protocols = set()
+            for line in run('-protocols').splitlines():
+                line = line.strip()
+                if line == 'Output:':
+                    break
+                if line and not line.endswith(':'):
+                    protocols.add(line)
+
+            # "-encoders" rows look like " A....D libopus    libopus Opus"
+            encoders = set()
+            for line in run('-encoders').splitlines():
+                parts = line.split()
+                if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] == 'A':
+                    encoders.add(parts[1])
+
+            http_options = set()
+            for line in run('-h', 'protocol=http').splitlines():
+                parts = line.split()
+                if parts and parts[0].startswith('-'):
+                    http_options.add(parts[0][1:])
+        except (OSError, subprocess.SubprocessError, IndexError) as e:
+            logger.error(f"Could not probe FFmpeg at {path}: {e}")
+            return cls(path)
+
+        capabilities = cls(path, version, protocols, encoders, http_options)
+        logger.info(
+            f"Using FFmpeg path: {path} ({version}) - libopus: {capabilities.has_libopus}, "
+            f"https: {capabilities.supports_https}, reconnect: {capabilities.supports_reconnect}"
+        )
+        if not capabilities.supports_https:
+            logger.error("FFmpeg was built without https support - YouTube streams will not play")
+        return capabilities
+
+# Capabilities of the ffmpeg binary; probed in setup_hook, or on first use if that hasn't run yet
+def get_ffmpeg():
+    if bot.ffmpeg is None:
+        bot.ffmpeg = FFmpegCapabilities.probe()
+    return bot.ffmpeg
+
+# Helper function to clean up processes - hands them to the supervisor, never blocks
+def cleanup_processes(player, process=None):
+    try:
+        bot.processes.stop(process or player.current_process)
+    except Exception as e:
+        logger.error(f"Error in cleanup_processes: {e}")
+
+@bot.event
+async def on_ready():
+    logger.info(f"Bot logged in as {bot.user}")
+    # on_ready fires again after every gateway reconnect - only the first one measures startup
+    if bot.ready_seconds is None:
+        bot.ready_seconds = time.perf_counter() - STARTED_AT
+        logger.info(f"Ready in {bot.ready_seconds:.2f}s (setup_hook {bot.setup_seconds:.2f}s)")
+
+# Only fired in sharded mode
+@bot.event
+async def on_shard_ready(shard_id):
+    logger.info(f"Shard {shard_id}/{bot.shard_count} ready")
+
+# Evict a guild's player once the bot leaves voice there (unless we are reconnecting)
+@bot.event
+async def on_voice_state_update(member, before, after):
+    if member.id != bot.user.id or after.channel is not None:
+        return
+    player = bot.players.get(member.guild.id)
+    if player and not player.reconnect_voice:
+        bot.evict_player(member.guild.id)
+
+# Custom PCM audio source backed by a preallocated ring buffer of 20ms frames.
+# A reader thread keeps it filled READAHEAD_SECONDS ahead of playback so ffmpeg/network
+# hiccups never block the voice thread, and played frames are kept for instant seeks.
+class BufferedPCMAudio(discord.AudioSource):
+    def __init__(self, source, volume=1.0, start_position=0.0, readahead_seconds=READAHEAD_SECONDS, history_seconds=SEEK_BUFFER_SECONDS):
+        self.source = source
+        self._is_opus = False
+        self.start_position = start_position  # Track position of frame index 0
+        self.volume = volume  # Gain applied to every frame, like discord.PCMVolumeTransformer
+        self.readahead_frames = max(2, int(readahead_seconds / FRAME_DURATION))
+        self.capacity = self.readahead_frames + max(1, int(history_seconds / FRAME_DURATION))
+        self.buffer = bytearray(self.capacity * FRAME_SIZE)
+        self.view = memoryview(self.buffer)
+        # One ctypes view per slot - discord.py's encoder takes these without copying the frame
+        self.frames = [(ctypes.c_char * FRAME_SIZE).from_buffer(self.buffer, slot * FRAME_SIZE) for slot in range(self.capacity)]
+        # Absolute frame indexes since the start position; slot = index % capacity
+        self.write_index = 0
+        self.read_index = 0
+        self.eof = False
+        self.closed = False
+        self.ended = False  # Every frame was played - the heartbeat tells a finished song from a dead one by this
+        self.cond = threading.Condition()
+        # Stats for tuning jitter
+        self.underruns = 0
+        self.frames_played = 0
+        self.min_fill = self.readahead_frames
+        self.fill_total = 0
+        self.reader = threading.Thread(target=self._fill, name="pcm-reader", daemon=True)
+        self.reader.start()
+
+    # Reader thread - pull whole frames from ffmpeg into free slots
+    def _fill(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.closed and self.write_index - self.read_index >= self.readahead_frames:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    offset = (self.write_index % self.capacity) * FRAME_SIZE
+
+                got = read_frame_into(self.source, self.view[offset:offset + FRAME_SIZE])
+
+                with self.cond:
+                    if got:
+                        self.write_index += 1
+                    if got < FRAME_SIZE:
+                        self.eof = True
+                    self.cond.notify_all()
+                    if self.eof:
+                        return
+        except Exception as e:
+            if not self.closed:
+                logger.error(f"Error reading audio data: {e}")
+            with self.cond:
+                self.eof = True
+                self.cond.notify_all()
+        finally:
+            if self.closed:
+                self._close_source()
+
+    @property
+    def fill_level(self):
+        return self.write_index - self.read_index
+
+    # Track position of the next frame to be played; seeks move read_index so this follows them
+    @property
+    def position(self):
+        return self.start_position + self.read_index * FRAME_DURATION
+
+    def read(self):
+        with self.cond:
+            if self.read_index >= self.write_index and not self.eof and not self.closed:
+                # Underrun - the reader thread hasn't caught up yet
+                self.underruns += 1
+                metrics.underruns.inc()
+                wait_start = time.time()
+                while self.read_index >= self.write_index and not self.eof and not self.closed:
+                    self.cond.wait()
+                time_diff = time.time() - wait_start
+                if time_diff > 0.1:  # More than 100ms waiting for audio
+                    read_delays.record(time_diff)
+            if self.read_index >= self.write_index:
+                self.ended = self.eof
+                return b''
+            frame = self.frames[self.read_index % self.capacity]
+            self.read_index += 1
+            self.frames_played += 1
+            fill = self.write_index - self.read_index
+            self.fill_total += fill
+            if fill < self.min_fill:
+                self.min_fill = fill
+            self.cond.notify_all()
+
+        if self.volume != 1.0:
+            return audioop.mul(frame, 2, self.volume)
+        return frame
+
+    # Move the play cursor by the given seconds inside the buffered window (played history
+    # plus read-ahead). Returns False when the target is outside it and ffmpeg has to be respawned.
+    def seek(self, seconds):
+        with self.cond:
+            target = self.read_index + int(round(seconds / FRAME_DURATION))
+            # The oldest slot may be mid-overwrite by the reader thread, so it is excluded
+            oldest = max(0, self.write_index - self.capacity + 1)
+            if target < oldest or target > self.write_index:
+                return False
+            self.read_index = target
+            self.cond.notify_all()
+        return True
+
+    def stats(self):
+        return {
+            "frames_played": self.frames_played,
+            "underruns": self.underruns,
+            "fill_seconds": self.fill_level * FRAME_DURATION,
+            "min_fill_seconds": self.min_fill * FRAME_DURATION,
+            "avg_fill_seconds": (self.fill_total / self.frames_played * FRAME_DURATION) if self.frames_played else 0.0,
+        }
+
+    def _close_source(self):
+        try:
+            self.source.close()
+        except:
+            pass
+
+    def cleanup(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        # Closing the pipe under a blocked readinto can hang, so the reader closes it on exit
+        if not self.reader.is_alive():
+            self._close_source()
+
+# One ffmpeg PCM decode broadcast to every guild playing the same track at nearby positions.
+# Subscribers read straight out of the shared ring (no copies) with their own cursor; the reader
+# thread stays READAHEAD_SECONDS ahead of the furthest subscriber and keeps SEEK_BUFFER_SECONDS of
+# history, so everyone within that window can be served from the same frames.
+class SharedPCMStream:
+    def __init__(self, registry, video_id, audio_input, local, process, start_position,
+                 readahead_seconds=READAHEAD_SECONDS, history_seconds=SEEK_BUFFER_SECONDS):
+        self.registry = registry
+        self.video_id = video_id
+        self.audio_input = audio_input  # Stream URL or cached file, reused if a subscriber needs its own decoder
+        self.local = local
+        self.process = process
+        self.source = process.stdout
+        self.start_position = start_position  # Track position of frame index 0
+        self.readahead_frames = max(2, int(readahead_seconds / FRAME_DURATION))
+        self.capacity = self.readahead_frames + max(1, int(history_seconds / FRAME_DURATION))
+        self.buffer = bytearray(self.capacity * FRAME_SIZE)
+        self.view = memoryview(self.buffer)
+        self.frames = [(ctypes.c_char * FRAME_SIZE).from_buffer(self.buffer, slot * FRAME_SIZE) for slot in range(self.capacity)]
+        self.write_index = 0
+        self.eof = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.subscribers = []
+        self.reader = threading.Thread(target=self._fill, name="pcm-shared-reader", daemon=True)
+
+    def start(self):
+        self.reader.start()
+
+    # Whether a subscriber at this frame can be served without starving the others (call with cond held).
+    # The frame must be decoded or next up, and must survive the reader running a full read-ahead past the leader.
+    def _can_hold(self, index, exclude=None):
+        if self.closed or index > self.write_index:
+            return False
+        leader = max([s.read_index for s in self.subscribers if s is not exclude] + [index])
+        return index >= max(self.write_index, leader + self.readahead_frames) - self.capacity + 2
+
+    def attach(self, subscriber, index):
+        with self.cond:
+            if not self._can_hold(index):
+                return False
+            subscriber.read_index = index
+            subscriber.stream = self
+            self.subscribers.append(subscriber)
+            self.cond.notify_all()
+        return True
+
+    def remove(self, subscriber):
+        with self.cond:
+            if subscriber not in self.subscribers:
+                return
+            self.subscribers.remove(subscriber)
+            if subscriber.stream is self:
+                subscriber.stream = None
+                subscriber.detached_position = self.start_position + subscriber.read_index * FRAME_DURATION
+            last = not self.subscribers
+            if last:
+                self.closed = True
+            self.cond.notify_all()
+        if last:
+            self.registry.closed(self)
+            if not self.reader.is_alive():
+                self._close_source()
+
+    def _fill(self):
+        try:
+            while True:
+                with self.cond:
+                    while (not self.closed and self.subscribers
+                           and self.write_index - max(s.read_index for s in self.subscribers) >= self.readahead_frames):
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    # Paused guilds and prefetched tracks that haven't started would pin the ring
+                    # and starve everyone else - hand them their own decoder instead
+                    for subscriber in [s for s in self.subscribers if self.write_index - s.read_index >= self.capacity - 1]:
+                        position = self.start_position + subscriber.read_index * FRAME_DURATION
+                        self.subscribers.remove(subscriber)
+                        subscriber.stream = None
+                        subscriber.detached_position = position
+                        self.registry.detached(subscriber, self, position)
+                    if not self.subscribers:
+                        self.closed = True
+                        self.cond.notify_all()
+                        self.registry.closed(self)
+                        return
+                    offset = (self.write_index % self.capacity) * FRAME_SIZE
+
+                got = read_frame_into(self.source, self.view[offset:offset + FRAME_SIZE])
+
+                with self.cond:
+                    if got:
+                        self.write_index += 1
+                    if got < FRAME_SIZE:
+                        self.eof = True
+                    self.cond.notify_all()
+                    if self.eof:
+                        return
+        except Exception as e:
+            if not self.closed:
+                logger.error(f"Error reading shared audio data: {e}")
+            with self.cond:
+                self.eof = True
+                self.cond.notify_all()
+        finally:
+            if self.closed:
+                self._close_source()
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger("MusicBot")
+    def _close_source(self):
+        try:
+            self.source.close()
+        except:
+            pass
 
-intents = discord.Intents.default()
-intents.message_content = True
+# A guild's cursor into a SharedPCMStream - same interface as BufferedPCMAudio, including in-place volume
+# and buffered seeks. If it is moved to another stream, reads hand out silence until the move completes.
+class SharedPCMAudio(discord.AudioSource):
+    def __init__(self, volume=1.0):
+        self.stream = None
+        self.read_index = 0
+        self.detached_position = 0.0  # Where playback stopped while no stream is attached
+        self.ended = False
+        self.volume = volume
+        self.closed = False
+        self.underruns = 0
+        self.frames_played = 0
+        self.min_fill = 0
+        self.fill_total = 0
 
-# Bot Setup
-class MusicBot(commands.Bot):
-    def __init__(self):
-        super().__init__(command_prefix="!", intents=intents)
-        self.queue = deque()
-        self.current_song = None
-        self.current_duration = 0
-        self.current_timestamp = 0
-        self.playing_message = None
-        self.is_paused = False
-        self.volume = 100  # Default volume (0-100)
-        self.seeking = False  # Flag to prevent multiple seek operations at once
-        self.current_process = None  # Track the current ffmpeg process
-        self.process_start_time = 0  # Track when the process started
-        self.reconnect_voice = False
-        self.voice_reconnect_task = None
-        self.heartbeat_task = None
-        # Add a buffer to store audio data
-        self.audio_buffer = bytearray(8192)  # 8KB buffer
+    @property
+    def fill_level(self):
+        stream = self.stream
+        return stream.write_index - self.read_index if stream else 0
 
-    async def setup_hook(self):
-        await self.tree.sync()
-        # Start voice connection health check
-        self.heartbeat_task = self.heartbeat.start()
+    @property
+    def position(self):
+        stream = self.stream
+        if stream is None:
+            return self.detached_position
+        return stream.start_position + self.read_index * FRAME_DURATION
 
-    # Improved heartbeat task to check voice connection health
-    @tasks.loop(seconds=10)  # Increased frequency from 30 to 10 seconds
-    async def heartbeat(self):
-        for guild in self.guilds:
-            # Check if we have a voice client in this guild
-            if guild.voice_client and guild.voice_client.is_connected():
-                # If we're not playing and not paused, but have a current song, something might be wrong
-                if not guild.voice_client.is_playing() and not self.is_paused and self.current_song:
-                    # Check if ffmpeg process is still alive but audio stopped
-                    if self.current_process and self.current_process.poll() is None:
-                        # Process is still running but no audio - check how long it's been
-                        current_time = time.time()
-                        if current_time - self.process_start_time > 3:  # Reduced from 5 to 3 seconds
-                            logger.warning(f"Heartbeat detected stalled playback at {self.current_timestamp}s, attempting recovery")
-                            # Attempt recovery by restarting playback from current timestamp
-                            self.reconnect_voice = True
-                            current_position = self.current_timestamp
-                            
-                            # Clean up the existing process
-                            cleanup_processes()
-                            
-                            # Schedule reconnection
-                            if not self.voice_reconnect_task or self.voice_reconnect_task.done():
-                                self.voice_reconnect_task = self.loop.create_task(
-                                    reconnect_voice_client(guild, guild.voice_client.channel, current_position)
-                                )
-                else:
-                    # Even when playing, periodically check if the process is healthy
-                    if self.current_process and time.time() - self.process_start_time > 30:
-                        # Check if process is consuming CPU
-                        try:
-                            if psutil.pid_exists(self.current_process.pid):
-                                proc = psutil.Process(self.current_process.pid)
-                                # If CPU usage is extremely low for an active process, it might be stuck
-                                if proc.cpu_percent(interval=0.5) < 0.1 and guild.voice_client.is_playing():
-                                    logger.warning("Process appears to be stalled despite playback status")
-                                    # Force reconnection
-                                    self.reconnect_voice = True
-                                    current_position = self.current_timestamp
-                                    cleanup_processes()
-                                    
-                                    if not self.voice_reconnect_task or self.voice_reconnect_task.done():
-                                        self.voice_reconnect_task = self.loop.create_task(
-                                            reconnect_voice_client(guild, guild.voice_client.channel, current_position)
-                                        )
-                        except Exception as e:
-                            logger.error(f"Error checking process health: {e}")
+    def read(self):
+        while True:
+            stream = self.stream
+            if stream is None:
+                if self.closed:
+                    return b''
+                # Still a frame sent, so a slow rebind (e.g. a stream URL refresh) doesn't look like a stall
+                self.frames_played += 1
+                return SILENCE_FRAME
+            with stream.cond:
+                if self.stream is not stream:
+                    continue
+                if self.read_index >= stream.write_index and not stream.eof and not self.closed:
+                    self.underruns += 1
+                    metrics.underruns.inc()
+                    wait_start = time.time()
+                    while self.stream is stream and self.read_index >= stream.write_index and not stream.eof and not self.closed:
+                        stream.cond.wait()
+                    time_diff = time.time() - wait_start
+                    if time_diff > 0.1:
+                        read_delays.record(time_diff)
+                    if self.stream is not stream:
+                        continue
+                if self.read_index >= stream.write_index:
+                    self.ended = stream.eof
+                    return b''
+                frame = stream.frames[self.read_index % stream.capacity]
+                self.read_index += 1
+                self.frames_played += 1
+                fill = stream.write_index - self.read_index
+                self.fill_total += fill
+                if self.frames_played == 1 or fill < self.min_fill:
+                    self.min_fill = fill
+                stream.cond.notify_all()
+            break
 
-    @heartbeat.before_loop
-    async def before_heartbeat(self):
-        await self.wait_until_ready()
+        if self.volume != 1.0:
+            return audioop.mul(frame, 2, self.volume)
+        return frame
 
-bot = MusicBot()
+    # Seek inside the shared window; False means the caller falls back to a dedicated decoder
+    def seek(self, seconds):
+        stream = self.stream
+        if stream is None:
+            return False
+        with stream.cond:
+            target = self.read_index + int(round(seconds / FRAME_DURATION))
+            if self.stream is not stream or not stream._can_hold(target, exclude=self):
+                return False
+            self.read_index = target
+            stream.cond.notify_all()
+        return True
 
-# Helper function to get ffmpeg path
-def get_ffmpeg_path():
-    if os.name == 'nt':  # Windows
-        ffmpeg_path = os.path.join(os.path.dirname(__file__), "ffmpeg", "ffmpeg.exe")
-        if not os.path.exists(ffmpeg_path):
-            # Try system path
-            ffmpeg_path = "ffmpeg"
-    else:  # Linux/Mac
-        # Try using system ffmpeg first
-        if subprocess.run(['which', 'ffmpeg'], capture_output=True).returncode == 0:
-            ffmpeg_path = 'ffmpeg'
-        else:
-            ffmpeg_path = os.path.join(os.path.dirname(__file__), "ffmpeg", "ffmpeg")
-    
-    logger.info(f"Using FFmpeg path: {ffmpeg_path}")
-    return ffmpeg_path
+    def stats(self):
+        return {
+            "frames_played": self.frames_played,
+            "underruns": self.underruns,
+            "fill_seconds": self.fill_level * FRAME_DURATION,
+            "min_fill_seconds": self.min_fill * FRAME_DURATION,
+            "avg_fill_seconds": (self.fill_total / self.frames_played * FRAME_DURATION) if self.frames_played else 0.0,
+        }
 
-# Helper function to clean up processes - modified to use process ID
-def cleanup_processes(specific_pid=None):
-    try:
-        if specific_pid:
-            # Only terminate a specific process
-            try:
-                proc = psutil.Process(specific_pid)
-                if proc.is_running():
-                    logger.info(f"Terminating specific process with PID {specific_pid}")
-                    proc.terminate()
-                    proc.wait(timeout=3)  # Wait for termination
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.TimeoutExpired) as e:
-                logger.warning(f"Exception during specific process cleanup: {e}")
-        elif bot.current_process:
-            # Only terminate the bot's current process
-            try:
-                if bot.current_process.poll() is None:
-                    logger.info("Terminating current bot process")
-                    bot.current_process.terminate()
-                    # Wait a moment for process to terminate
-                    try:
-                        bot.current_process.wait(timeout=3)
-                    except subprocess.TimeoutExpired:
-                        logger.warning("Process termination timed out, forcing kill")
-                        if os.name == 'nt':  # Windows
-                            subprocess.run(['taskkill', '/F', '/T', '/PID', str(bot.current_process.pid)])
-                        else:  # Linux/Mac
-                            bot.current_process.kill()
-            except Exception as e:
-                logger.error(f"Error terminating current process: {e}")
-    except Exception as e:
-        logger.error(f"Error in cleanup_processes: {e}")
+    def cleanup(self):
+        self.closed = True
+        stream = self.stream
+        if stream is not None:
+            stream.remove(self)
 
-@bot.event
-async def on_ready():
-    logger.info(f"Bot logged in as {bot.user}")
+# Bot-side source for a worker job: Opus packets arrive from the worker's receiver thread and are
+# handed to discord.py as-is. Volume changes are forwarded to the worker; seeks always respawn.
+class WorkerAudio(discord.AudioSource):
+    def __init__(self, worker, job_id, volume, start_position, readahead_seconds=READAHEAD_SECONDS):
+        self.worker = worker
+        self.job_id = job_id
+        self._volume = volume
+        self.start_position = start_position
+        self.readahead_frames = max(WORKER_CREDIT_FRAMES, int(readahead_seconds / FRAME_DURATION))
+        self.packets = deque()
+        self.cond = threading.Condition()
+        self.eof = False
+        self.closed = False
+        self.lost = False  # The worker died; recovery restarts the guild from position
+        self.ended = False
+        self.unacknowledged = 0  # Frames consumed since the last credit message
+        self.underruns = 0
+        self.frames_played = 0
 
-# Custom PCM audio source with larger buffer
-class BufferedPCMAudio(discord.AudioSource):
-    def __init__(self, source, buffer_size=4096):
+    def deliver(self, packets):
+        with self.cond:
+            self.packets.extend(packets)
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def lose(self):
+        with self.cond:
+            self.lost = True
+            self.cond.notify_all()
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        if value != self._volume:
+            self._volume = value
+            self.worker.send(("volume", self.job_id, value))
+
+    @property
+    def fill_level(self):
+        return len(self.packets)
+
+    @property
+    def position(self):
+        return self.start_position + self.frames_played * FRAME_DURATION
+
+    def read(self):
+        with self.cond:
+            if not self.packets and not self.eof and not self.closed and not self.lost:
+                self.underruns += 1
+                metrics.underruns.inc()
+                wait_start = time.time()
+                while not self.packets and not self.eof and not self.closed and not self.lost:
+                    self.cond.wait()
+                time_diff = time.time() - wait_start
+                if time_diff > 0.1:
+                    read_delays.record(time_diff)
+            if not self.packets:
+                # Ending the stream here would skip to the next song; hold the position instead
+                if self.lost and not self.closed:
+                    return discord.opus.OPUS_SILENCE
+                self.ended = self.eof
+                return b''
+            packet = self.packets.popleft()
+        self.frames_played += 1
+        self.unacknowledged += 1
+        if self.unacknowledged >= WORKER_CREDIT_FRAMES:
+            self.worker.send(("credit", self.job_id, self.unacknowledged))
+            self.unacknowledged = 0
+        return packet
+
+    def is_opus(self):
+        return True
+
+    def seek(self, seconds):
+        return False
+
+    def stats(self):
+        return {
+            "frames_played": self.frames_played,
+            "underruns": self.underruns,
+            "fill_seconds": self.fill_level * FRAME_DURATION,
+        }
+
+    def cleanup(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.worker.sources.pop(self.job_id, None)
+        self.worker.send(("stop", self.job_id))
+
+# Sources that take volume changes in place (and may be able to seek inside their buffer)
+PCM_SOURCES = (BufferedPCMAudio, SharedPCMAudio, WorkerAudio)
+
+# Opus audio source - hands Ogg/Opus packets from ffmpeg straight to discord.py without re-encoding
+class BufferedOpusAudio(discord.AudioSource):
+    def __init__(self, source, start_position=0.0):
         self.source = source
-        self.buffer = bytearray(buffer_size)
-        self.buffer_size = buffer_size
-        self.read_size = 3840  # Discord's read frame size (typically 20ms of 48kHz audio)
-        self._is_opus = False
+        self._packet_iter = discord.oggparse.OggStream(source).iter_packets()
         self.last_read_time = time.time()
+        self.start_position = start_position
+        self.frames_played = 0  # Each Opus packet carries 20ms of audio
+        self.ended = False
+
+    @property
+    def position(self):
+        return self.start_position + self.frames_played * FRAME_DURATION
 
     def read(self):
-        # Read data from source into our buffer
         try:
-            bytes_read = self.source.read(self.read_size)
+            packet = next(self._packet_iter, b'')
+            # Stream headers aren't audio
+            while packet.startswith((b'OpusHead', b'OpusTags')):
+                packet = next(self._packet_iter, b'')
+            if packet:
+                self.frames_played += 1
+            else:
+                self.ended = True
             current_time = time.time()
             time_diff = current_time - self.last_read_time
-            
+
             # Log if read took too long
             if time_diff > 0.1:  # More than 100ms between reads
-                logger.warning(f"Audio read delay: {time_diff:.3f}s")
-            
+                read_delays.record(time_diff)
+
             self.last_read_time = current_time
-            
-            if not bytes_read:
-                return b''
-                
-            return bytes_read
+            return packet
         except Exception as e:
-            logger.error(f"Error reading audio data: {e}")
+            logger.error(f"Error reading opus data: {e}")
             return b''
 
+    def is_opus(self):
+        return True
+
     def cleanup(self):
         try:
             self.source.close()
         except:
             pass
 
+# Opus source reading a cached Ogg file directly - seeks jump to the page's byte offset, no ffmpeg needed
+class OggOpusFileAudio(discord.AudioSource):
+    def __init__(self, path, index, position=0):
+        self.file = open(path, 'rb')
+        # Start at the page that contains the target sample (Opus granules count 48kHz samples)
+        granules = [granule for granule, _ in index]
+        page = bisect.bisect_right(granules, int(position * 48000))
+        if page < len(index):
+            self.file.seek(index[page][1])
+        else:
+            self.file.seek(0, os.SEEK_END)
+        # Playback starts where the previous page ended, slightly before the requested position
+        self.start_position = granules[page - 1] / 48000 if page > 0 else 0.0
+        self.frames_played = 0
+        self.ended = False
+        self._packet_iter = self._iter_packets()
+
+    @property
+    def position(self):
+        return self.start_position + self.frames_played * FRAME_DURATION
+
+    def _iter_packets(self):
+        partial = b''
+        first_page = True
+        while self.file.read(4) == b'OggS':
+            page = discord.oggparse.OggPage(self.file)
+            # After a seek the first packet may be the tail of one that started on the previous page
+            drop_first = first_page and page.flag & 0x01
+            first_page = False
+            for data, complete in page.iter_packets():
+                partial += data
+                if complete:
+                    packet, partial = partial, b''
+                    if drop_first:
+                        drop_first = False
+                        continue
+                    if packet.startswith((b'OpusHead', b'OpusTags')):
+                        continue
+                    yield packet
+
+    def read(self):
+        try:
+            packet = next(self._packet_iter, b'')
+            if packet:
+                self.frames_played += 1
+            else:
+                self.ended = True
+            return packet
+        except Exception as e:
+            logger.error(f"Error reading cached audio: {e}")
+            return b''
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        try:
+            self.file.close()
+        except:
+            pass
+
+# Build the ffmpeg command line for the configured audio mode
+def build_ffmpeg_command(ffmpeg, audio_url, position, volume_multiplier, opus=False, passthrough=False, local=False):
+    command = [ffmpeg.path]
+    if not local:
+        command += ffmpeg.reconnect_args()
+    command += [
+        '-ss', str(position),
+        '-i', audio_url,
+        '-loglevel', 'warning',
+        '-map_metadata', '-1',
+        '-vn',
+    ]
+    if opus and passthrough:
+        # Source is already Opus - remux the packets into Ogg without decoding
+        command += ['-c:a', 'copy', '-f', 'opus']
+    elif opus:
+        # Let ffmpeg (libopus) do the encoding instead of the bot process
+        command += [
+            '-filter:a', f'volume={volume_multiplier}',
+            '-c:a', 'libopus',
+            '-b:a', f'{OPUS_BITRATE}k',
+            '-ar', '48000',
+            '-ac', '2',
+            '-f', 'opus',
+        ]
+    else:
+        command += [
+            '-filter:a', f'volume={volume_multiplier}',
+            '-f', 's16le',
+            '-ar', '48000',
+            '-ac', '2',
+            '-bufsize', '8M',  # 8MB buffer
+        ]
+    command.append('pipe:1')
+    return command
+
+# Wrapper handed to the voice client - when the current track runs dry it switches to the
+# prefetched one inside the same read() call, so there is no gap between songs
+class GaplessAudio(discord.AudioSource):
+    def __init__(self, source, on_switch, started_at=None):
+        self.source = source
+        self.upcoming = None
+        self.on_switch = on_switch  # Called from the voice thread with the new source
+        self.lock = threading.Lock()
+        self.started_at = started_at  # perf_counter when the track was requested, for time-to-first-audio
+
+    def queue_next(self, source):
+        with self.lock:
+            self.upcoming = source
+
+    # Detach the prefetched source so it can be played elsewhere (or discarded)
+    def take_next(self):
+        with self.lock:
+            source, self.upcoming = self.upcoming, None
+        return source
+
+    def read(self):
+        start = time.perf_counter()
+        data = self._read()
+        now = time.perf_counter()
+        metrics.frame_read_seconds.observe(now - start)
+        if self.started_at is not None and data:
+            metrics.first_audio_seconds.observe(now - self.started_at)
+            self.started_at = None
+        return data
+
+    def _read(self):
+        data = self.source.read()
+        if data:
+            return data
+        upcoming = self.take_next()
+        if upcoming is None:
+            return b''
+        previous, self.source = self.source, upcoming
+        previous.cleanup()
+        self.on_switch(upcoming)
+        return upcoming.read()
+
+    @property
+    def position(self):
+        return self.source.position
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    # The upcoming source is owned by the player's prefetch state, so only the current one is released here
+    def cleanup(self):
+        self.source.cleanup()
+
+# A queue entry whose stream is verified and whose decoder is already buffering
+class PrefetchedTrack:
+    __slots__ = ("entry", "audio_url", "process", "source")
+
+    def __init__(self, entry, audio_url, process, source):
+        self.entry = entry
+        self.audio_url = audio_url
+        self.process = process
+        self.source = source
+
+# Stand-in for an Interaction when playback is started without a command (reconnects, restored players).
+# Replies go straight to a text channel.
+class ChannelInteraction:
+    def __init__(self, channel):
+        self.channel = channel
+        self.guild = channel.guild
+        self.followup = self
+        self.response = self
+
+    async def send(self, *args, ephemeral=False, wait=False, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+    async def send_message(self, *args, ephemeral=False, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+    def is_done(self):
+        return True
+
 # Voice reconnection helper with improved stability
-async def reconnect_voice_client(guild, channel, timestamp):
-    logger.info(f"Attempting to reconnect voice in guild {guild.id}, resuming at {timestamp}s")
+async def reconnect_voice_client(guild, channel, timestamp, title=None, text_channel=None):
+    logger.info(f"Attempting to reconnect voice in guild {guild.id}, resuming at {timestamp:.1f}s")
+    metrics.reconnects.inc()
+    player = bot.get_player(guild)
     try:
         # Disconnect if connected
         if guild.voice_client:
@@ -210,88 +2932,176 @@ async def reconnect_voice_client(guild, channel, timestamp):
         
         # Reconnect
         vc = await channel.connect()
-        
+
+        # UI updates go to the channel of the Now Playing message, or the first one we can write to
+        if text_channel is None and player.playing_message:
+            text_channel = player.playing_message.channel
+        if text_channel is None:
+            text_channel = next((c for c in guild.text_channels if c.permissions_for(guild.me).send_messages), None)
+        if text_channel is None:
+            logger.warning(f"No text channel to post to in guild {guild.id}, not resuming playback")
+            return
+        interaction = ChannelInteraction(text_channel)
+
         # Resume playback if we have a current song
-        if bot.current_song:
-            bot.current_timestamp = timestamp
-            bot.seeking = False
-            
-            # Find an interaction to use for UI updates - this is a workaround
-            for channel in guild.text_channels:
-                if channel.permissions_for(guild.me).send_messages:
-                    class DummyInteraction:
-                        async def followup(self):
-                            return channel
-                        
-                        response = property(lambda self: self)
-                        
-                        @staticmethod
-                        async def send_message(*args, **kwargs):
-                            return await channel.send(*args, **kwargs)
-                        
-                        @staticmethod
-                        async def is_done():
-                            return True
-                    
-                    dummy_interaction = DummyInteraction()
-                    dummy_interaction.guild = guild
-                    
-                    # Resume playback
-                    await play_audio_at_position(vc, dummy_interaction, bot.current_song, 
-                                               bot.current_timestamp, bot.current_duration)
-                    break
+        if player.current_song:
+            player.current_timestamp = timestamp
+            player.seeking = False
+            await play_audio_at_position(vc, interaction, player.current_song,
+                                       player.current_timestamp, player.current_duration, title)
+        elif player.queue:
+            player.reconnect_voice = False
+            await play_next_in_queue(vc, interaction)
     except Exception as e:
+        metrics.reconnect_failures.inc()
         logger.error(f"Failed to reconnect voice: {e}")
     finally:
-        bot.reconnect_voice = False
+        player.reconnect_voice = False
+
+# Resume a player restored from the state store: refresh its stream URL, then rejoin voice
+async def resume_player(player, guild, channel, text_channel, title):
+    if player.current_video_id:
+        try:
+            player.current_song = await bot.metadata_cache.stream_url(
+                player.current_video_id, max(0, player.current_duration - player.current_timestamp)
+            )
+            track = bot.metadata_cache.get(player.current_video_id)
+            title = title or (track.title if track else None)
+        except Exception as e:
+            logger.error(f"Couldn't resume {player.current_video_id} in guild {guild.id}: {e}")
+            player.current_video_id = None
+    await reconnect_voice_client(guild, channel, player.current_timestamp, title or "Unknown title", text_channel)
+
+# Guild volume combined with the track's loudness correction
+def track_volume(player, video_id):
+    return player.volume / 100.0 * bot.loudness.gain(video_id)
+
+# Start ffmpeg and wrap its output in the right AudioSource for the configured mode.
+# Returns (process, source); process is None when a cached file is read directly.
+def spawn_decoder(player, audio_url, position, video_id):
+    ffmpeg = get_ffmpeg()
+    volume_multiplier = track_volume(player, video_id)
+    track = bot.metadata_cache.get(video_id) if video_id else None
+    # In PCM mode volume is applied by BufferedPCMAudio, so ffmpeg always decodes at unity gain
+    use_opus = AUDIO_MODE == "opus"
+    ffmpeg_volume = volume_multiplier if use_opus else 1.0
+
+    # Hot tracks come from the local disk cache instead of the network
+    cached_path = bot.audio_cache.lookup(video_id) if video_id else None
+    caching = cached_path is None and bot.audio_cache.schedule_populate(video_id, audio_url, track.acodec if track else None)
+    # A track being cached gets its loudness measured from the file once it is written, so the stream
+    # is never fetched a third time; without the disk cache the stream is measured directly
+    if not caching:
+        bot.loudness.schedule(video_id, cached_path or audio_url, local=bool(cached_path))
+    if cached_path and use_opus and ffmpeg_volume == 1.0:
+        return None, OggOpusFileAudio(cached_path, bot.audio_cache.page_index(video_id), position)
+
+    # Opus sources at unity volume can skip decoding entirely
+    source_codec = "opus" if cached_path else (track.acodec if track else None)
+    passthrough = use_opus and ffmpeg_volume == 1.0 and source_codec == "opus"
+    if use_opus and not passthrough and not ffmpeg.has_libopus:
+        # This ffmpeg can't encode Opus - fall back to PCM for this stream
+        use_opus = False
+        ffmpeg_volume = 1.0
+
+    # Worker processes decode to PCM and apply volume and Opus encoding themselves
+    # (Opus passthrough is just a remux, so it stays local)
+    if bot.audio_workers.enabled and not passthrough:
+        source = bot.audio_workers.open(
+            build_ffmpeg_command(ffmpeg, cached_path or audio_url, position, 1.0, local=bool(cached_path)),
+            volume_multiplier, position
+        )
+        if source is not None:
+            return None, source
+
+    # PCM is decoded at unity gain regardless of guild, so another guild's decoder of this track can be reused
+    share = SHARED_DECODE and not use_opus and bool(video_id)
+    if share:
+        source = bot.shared_decoders.join(video_id, position, volume_multiplier)
+        if source is not None:
+            logger.info(f"Sharing a running decoder for {video_id} in guild {player.guild_id}")
+            return None, source
+
+    command = build_ffmpeg_command(ffmpeg, cached_path or audio_url, position, ffmpeg_volume, use_opus, passthrough, local=bool(cached_path))
+    if share:
+        # The shared stream owns its ffmpeg, so stopping this guild never cuts off the others
+        process = spawn_ffmpeg(SHARED_OWNER, command)
+        return None, bot.shared_decoders.start(video_id, cached_path or audio_url, bool(cached_path), process, position, volume_multiplier)
+
+    process = spawn_ffmpeg(player.guild_id, command)
+    if use_opus:
+        source = BufferedOpusAudio(process.stdout, start_position=position)
+        logger.info(f"Streaming Opus ({'passthrough' if passthrough else 'ffmpeg encode'}) in guild {player.guild_id}")
+    else:
+        source = BufferedPCMAudio(process.stdout, volume=volume_multiplier, start_position=position)
+    return process, source
+
+# Create ffmpeg process with improved buffer settings and higher priority
+def spawn_ffmpeg(owner, command):
+    return bot.processes.spawn(
+        owner,
+        command,
+        bufsize=8192,  # Increased buffer size
+        # Set higher process priority
+        creationflags=subprocess.HIGH_PRIORITY_CLASS if os.name == 'nt' else 0
+    )
 
 # Play audio at specific position - improved for stability
-async def play_audio_at_position(vc, interaction, audio_url, position, duration, title=None):
+async def play_audio_at_position(vc, interaction, audio_url, position, duration, title=None, prefetched=None):
+    started_at = time.perf_counter()
+    player = bot.get_player(vc.guild)
+
+    # Make sure the stream URL outlives the rest of the track before handing it to ffmpeg
+    if player.current_video_id and prefetched is None:
+        try:
+            audio_url = await bot.metadata_cache.stream_url(player.current_video_id, max(0, duration - position))
+            player.current_song = audio_url
+        except Exception as e:
+            logger.error(f"Error refreshing stream URL for {player.current_video_id}: {e}")
+
     # Clean up any existing processes
-    cleanup_processes()
+    cleanup_processes(player)
     
-    ffmpeg_path = get_ffmpeg_path()
-    volume_multiplier = bot.volume / 100.0
-    was_paused = bot.is_paused
+    was_paused = player.is_paused
     
     # Update UI if we have a title
     if title:
-        await send_playing_ui(interaction, title, duration)
-    
+        await send_playing_ui(player, interaction, title, duration)
+
     try:
-        # Create ffmpeg process with improved buffer settings and higher priority
-        process = subprocess.Popen(
-            [
-                ffmpeg_path, 
-                '-reconnect', '1',
-                '-reconnect_streamed', '1',
-                '-reconnect_delay_max', '5',
-                '-ss', str(position), 
-                '-i', audio_url,
-                '-filter:a', f'volume={volume_multiplier}',
-                '-f', 's16le', 
-                '-ar', '48000', 
-                '-ac', '2',
-                '-bufsize', '8M',  # 8MB buffer
-                'pipe:1',
-                '-loglevel', 'warning'
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=8192,  # Increased buffer size
-            # Set higher process priority
-            creationflags=subprocess.HIGH_PRIORITY_CLASS if os.name == 'nt' else 0
-        )
+        # Reuse the decoder started by the prefetcher, or start a new one
+        if prefetched is not None:
+            process, buffered_source = prefetched.process, prefetched.source
+            # /volume only reaches the playing source, so the prefetched one may carry an older level
+            if isinstance(buffered_source, PCM_SOURCES):
+                buffered_source.volume = track_volume(player, player.current_video_id)
+        else:
+            process, buffered_source = spawn_decoder(player, audio_url, position, player.current_video_id)
         
         # Store the process and its start time
-        bot.current_process = process
-        bot.process_start_time = time.time()
-        
-        # Play the audio with our custom buffer
-        buffered_source = BufferedPCMAudio(process.stdout, buffer_size=8192)
-        vc.play(
+        player.current_process = process
+        player.process_start_time = time.time()
+
+        # Play the audio through the gapless wrapper so the prefetcher can chain the next song
+        chain = GaplessAudio(
             buffered_source,
-            after=lambda e: bot.loop.create_task(handle_playback_finished(vc, interaction, e))
+            on_switch=lambda source: asyncio.run_coroutine_threadsafe(
+                finish_gapless_switch(vc, interaction, source), bot.loop
+            ),
+            started_at=started_at
+        )
+
+        # Stop the previous source ourselves; its after-callback is ignored because it is no longer current
+        player.current_source = buffered_source
+        player.audio_chain = chain
+        player.clock_source = buffered_source
+        if vc.is_playing() or vc.is_paused():
+            vc.stop()
+        vc.play(
+            chain,
+            after=lambda e: asyncio.run_coroutine_threadsafe(
+                handle_playback_finished(vc, interaction, e, chain), bot.loop
+            )
         )
         
         # Restore pause state if needed
@@ -299,30 +3109,98 @@ async def play_audio_at_position(vc, interaction, audio_url, position, duration,
             vc.pause()
         
         # Start UI update task if not running
-        if not update_ui.is_running():
-            update_ui.start(vc, interaction)
+        if not player.update_ui.is_running():
+            player.update_ui.start(vc, interaction)
         
-        # Update UI with current position
-        if bot.playing_message:
-            try:
-                embed = bot.playing_message.embeds[0]
-                embed.set_field_at(
-                    0,
-                    name="Duration",
-                    value=f"{format_timestamp(position)} / {format_timestamp(duration)}"
-                )
-                await bot.playing_message.edit(embed=embed)
-            except Exception as e:
-                logger.error(f"Error updating UI after playback: {e}")
+        # Show the new position right away
+        bot.ui_scheduler.request(player, urgent=True)
     except Exception as e:
         logger.error(f"Error playing audio at position {position}: {e}")
         # Reset seeking flag
-        bot.seeking = False
+        player.seeking = False
+
+# Verify the next song's stream and start its decoder so it is buffered before the current one ends
+async def prefetch_next(player):
+    if not player.queue or player.audio_chain is None:
+        return
+    entry = player.queue.peek()
+    try:
+        audio_url = await bot.metadata_cache.stream_url(entry.video_id, entry.duration)
+        # The queue or the playing source may have changed while we were resolving
+        if player.queue.peek() is not entry or player.prefetched is not None or player.audio_chain is None:
+            return
+        process, source = spawn_decoder(player, audio_url, 0, entry.video_id)
+    except Exception as e:
+        # Private and deleted videos are common in big playlists - don't re-extract every second;
+        # play_next_in_queue tries once more and skips the entry if it still fails
+        logger.error(f"Error prefetching {entry.title}: {e}")
+        player.prefetch_failed = entry
+        return
+    player.prefetched = PrefetchedTrack(entry, audio_url, process, source)
+    player.audio_chain.queue_next(source)
+    logger.info(f"Prefetched next track in guild {player.guild_id}: {entry.title}")
+
+# Throw away a prefetched decoder (queue head changed, volume baked into it changed, stop)
+def discard_prefetch(player):
+    prefetched, player.prefetched = player.prefetched, None
+    if prefetched is None:
+        return
+    if player.audio_chain is not None and player.audio_chain.upcoming is prefetched.source:
+        player.audio_chain.take_next()
+    prefetched.source.cleanup()
+    if prefetched.process is not None:
+        cleanup_processes(player, prefetched.process)
+
+# Drop the prefetched decoder if the queue head is no longer the entry it was started for
+def sync_prefetch(player):
+    if player.prefetched is not None and player.queue.peek() is not player.prefetched.entry:
+        discard_prefetch(player)
+
+# Claim the prefetched decoder if it belongs to the given queue entry
+def take_prefetch(player, entry):
+    prefetched = player.prefetched
+    if prefetched is None:
+        return None
+    if prefetched.entry is not entry:
+        discard_prefetch(player)
+        return None
+    player.prefetched = None
+    if player.audio_chain is not None and player.audio_chain.upcoming is prefetched.source:
+        player.audio_chain.take_next()
+    return prefetched
+
+# Called once GaplessAudio has switched to the prefetched track - bring player state along
+async def finish_gapless_switch(vc, interaction, source):
+    player = bot.players.get(vc.guild.id)
+    if player is None or player.prefetched is None or player.prefetched.source is not source:
+        return
+    prefetched, player.prefetched = player.prefetched, None
+    if player.queue.peek() is prefetched.entry:
+        player.queue.popleft()
+    video_id, title, duration = prefetched.entry.video_id, prefetched.entry.title, prefetched.entry.duration
+    track = bot.metadata_cache.get(video_id)
+    if track is not None:
+        title, duration = track.title, track.duration or duration
+
+    # The previous ffmpeg has already hit EOF; reap it and adopt the prefetched one
+    cleanup_processes(player)
+    player.current_song = prefetched.audio_url
+    player.current_video_id = video_id
+    player.current_duration = duration
+    player.current_timestamp = 0
+    player.current_process = prefetched.process
+    player.current_source = source
+    player.clock_source = source
+    player.process_start_time = time.time()
+    if isinstance(source, PCM_SOURCES):
+        source.volume = track_volume(player, video_id)
+
+    await send_playing_ui(player, interaction, title, duration)
 
 # Play Command - improved
 @bot.tree.command(name="play", description="Play a song in a voice channel.")
-@app_commands.describe(url="The YouTube URL of the song to play.")
-async def play(interaction: discord.Interaction, url: str):
+@app_commands.describe(url="The YouTube URL of the song or playlist to play.", next="Play this song right after the current one.")
+async def play(interaction: discord.Interaction, url: str, next: bool = False):
     if not interaction.user.voice:
         await interaction.response.send_message("You must be in a voice channel to use this command.", ephemeral=True)
         return
@@ -346,146 +3224,148 @@ async def play(interaction: discord.Interaction, url: str):
 
     await interaction.response.defer()
 
-    # Improved YoutubeDL options for better stability
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "noplaylist": True,
-        "quiet": True,
-        "extract_flat": True,
-        "skip_download": True,
-        "force_generic_extractor": False,
-        # Add timeout options
-        "socket_timeout": 30,
-        "retries": 5,
-        "fragment_retries": 5
-    }
-
     try:
-        with YoutubeDL(ydl_opts) as ydl:
-            logger.info(f"Extracting info for URL: {url}")
-            info = ydl.extract_info(url, download=False)
+        # Resolve through the metadata cache; misses go to the extraction pool off the event loop
+        logger.info(f"Extracting info for URL: {url}")
+        track, info = await bot.metadata_cache.resolve(url, interaction=interaction)
             
-        if "entries" in info:  # It's a playlist
-            await interaction.followup.send("Playlists are not supported. Please provide a single video URL.")
-            return
-            
-        audio_url = info["url"]
-        title = info.get("title", "Unknown Title")
-        duration = info.get("duration", 0)
-
-        bot.queue.append((audio_url, title, duration))
-        await interaction.followup.send(f"Added to queue: **{title}**")
+        player = bot.get_player(interaction.guild)
+        if track is None:  # It's a playlist - enqueue the listing, streams are resolved near the head of the queue
+            tracks = bot.metadata_cache.add_flat_entries(info.get("entries") or [])
+            if not tracks:
+                await interaction.followup.send("That playlist has no playable entries.")
+                return
+            player.queue.extend((t.video_id, t.title, t.duration) for t in tracks)
+            sync_prefetch(player)
+            await interaction.followup.send(f"Added {len(tracks)} songs from **{info.get('title') or 'playlist'}** to the queue.")
+        else:
+            if next:
+                player.queue.insert_next(track.video_id, track.title, track.duration)
+                sync_prefetch(player)
+                await interaction.followup.send(f"Playing next: **{track.title}**")
+            else:
+                player.queue.append(track.video_id, track.title, track.duration)
+                await interaction.followup.send(f"Added to queue: **{track.title}**")
 
-        if not vc.is_playing() and not bot.is_paused:
+        if not vc.is_playing() and not player.is_paused:
             await play_next_in_queue(vc, interaction)
 
+    except asyncio.TimeoutError:
+        if not interaction.is_expired():
+            await interaction.followup.send("Timed out while looking up that URL. Please try again.")
     except Exception as e:
         logger.error(f"Error playing audio: {e}")
         await interaction.followup.send(f"An error occurred: {str(e)[:1900]}")  # Truncate long error messages
 
 # Play Next Song in Queue - Modified to use our new play_audio function
 async def play_next_in_queue(vc, interaction):
+    player = bot.get_player(vc.guild)
+
     # Don't play next if we're in the middle of reconnecting
-    if bot.reconnect_voice:
+    if player.reconnect_voice:
         return
         
     # Clean up any existing processes first
-    cleanup_processes()
+    cleanup_processes(player)
+    # The old song is over - don't let the heartbeat take the gap while the next one resolves for a stall
+    player.current_source = None
     
-    if bot.queue:
-        audio_url, title, duration = bot.queue.popleft()
-        bot.current_song = audio_url
-        bot.current_duration = duration
-        bot.current_timestamp = 0
-        bot.seeking = False  # Reset seeking flag for new song
+    # Unavailable songs are skipped in this loop rather than by recursing
+    while player.queue:
+        entry = player.queue.popleft()
+        video_id, title, duration = entry.video_id, entry.title, entry.duration
+        prefetched = take_prefetch(player, entry)
+        try:
+            audio_url = prefetched.audio_url if prefetched else await bot.metadata_cache.stream_url(video_id, duration)
+        except Exception as e:
+            logger.error(f"Error resolving stream for {title}: {e}")
+            await send_followup(interaction, f"Couldn't load **{title}**, skipping.")
+            continue
+        # Playlist entries only learn their real title/duration once resolved
+        track = bot.metadata_cache.get(video_id)
+        if track is not None:
+            title, duration = track.title, track.duration or duration
+        player.current_song = audio_url
+        player.current_video_id = video_id
+        player.current_duration = duration
+        player.current_timestamp = 0
+        player.seeking = False  # Reset seeking flag for new song
 
         # Play audio from beginning
-        await play_audio_at_position(vc, interaction, audio_url, 0, duration, title)
-    else:
-        bot.current_song = None
-        bot.current_process = None
-        if not interaction.response.is_done():
-            await interaction.followup.send("Queue is empty.")
+        await play_audio_at_position(vc, interaction, audio_url, 0, duration, title, prefetched=prefetched)
+        return
+
+    player.current_song = None
+    player.current_process = None
+    if not interaction.response.is_done():
+        await send_followup(interaction, "Queue is empty.")
+
+# Send a followup message, falling back to the interaction's channel once the 15-minute
+# interaction token has expired. Never raises - playback must carry on regardless.
+async def send_followup(interaction, *args, **kwargs):
+    try:
+        return await interaction.followup.send(*args, **kwargs)
+    except Exception as e:
+        channel = getattr(interaction, "channel", None)
+        if channel is None or isinstance(interaction, ChannelInteraction):
+            logger.error(f"Error sending message: {e}")
+            return None
+    kwargs.pop("ephemeral", None)
+    kwargs.pop("wait", None)
+    try:
+        return await channel.send(*args, **kwargs)
+    except Exception as e:
+        logger.error(f"Error sending message to channel {channel.id}: {e}")
+        return None
 
 # Handler for when playback finishes - modified to log errors
-async def handle_playback_finished(vc, interaction, error=None):
+async def handle_playback_finished(vc, interaction, error=None, source=None):
     if error:
         logger.error(f"Error during playback: {error}")
+
+    player = bot.players.get(vc.guild.id)
+    if player is None:
+        # Player was evicted (stopped or disconnected)
+        return
+    if source is not None and source is not player.audio_chain:
+        # A source we replaced (seek, volume change) finished - not the end of the song
+        return
     
     # Add a small delay to ensure seeking flag is properly set
     await asyncio.sleep(0.1)
     
     # Only auto-play next if not caused by seeking or manual stop
-    if not bot.seeking and bot.current_song and not bot.reconnect_voice:
-        await play_next_in_queue(vc, interaction)
+    if not player.seeking and player.current_song and not player.reconnect_voice:
+        try:
+            await play_next_in_queue(vc, interaction)
+        except Exception as e:
+            # Nothing reads the future this runs in, so log here or the error is lost
+            logger.error(f"Error starting the next song in guild {vc.guild.id}: {e}")
 
 # Send Playing UI with Buttons
-async def send_playing_ui(interaction, title, duration):
+async def send_playing_ui(player, interaction, title, duration):
     embed = discord.Embed(
         title="🎶 Now Playing",
         description=f"**{title}**",
         color=discord.Color.blue()
     )
-    embed.add_field(name="Duration", value=f"{format_timestamp(bot.current_timestamp)} / {format_timestamp(duration)}")
+    embed.add_field(name="Duration", value=f"{format_timestamp(player.current_timestamp)} / {format_timestamp(duration)}")
     embed.set_footer(text="Use the buttons below to control playback.")
 
     view = PlaybackControls()
 
-    if bot.playing_message:
+    if player.playing_message:
+        bot.ui_scheduler.forget(player.playing_message.id)
         try:
             # Attempt to delete the previous playing message if it exists
-            await bot.playing_message.delete()
+            await player.playing_message.delete()
         except discord.NotFound:
             pass  # If the message is already deleted, just ignore
         except Exception as e:
             logger.error(f"Error deleting previous message: {e}")
 
     # Send a new message with the updated UI
-    try:
-        bot.playing_message = await interaction.followup.send(embed=embed, view=view)
-    except Exception as e:
-        logger.error(f"Error sending playing UI: {e}")
-
-# Update UI Task - with improved error handling
-@tasks.loop(seconds=1)
-async def update_ui(vc, interaction):
-    try:
-        if vc.is_playing() and not bot.is_paused and not bot.seeking:
-            bot.current_timestamp += 1
-            # Ensure timestamp doesn't exceed duration
-            if bot.current_timestamp > bot.current_duration:
-                bot.current_timestamp = bot.current_duration
-                
-            # Check if playing_message still exists
-            if bot.playing_message:
-                try:
-                    embed = bot.playing_message.embeds[0]
-                    embed.set_field_at(
-                        0,
-                        name="Duration",
-                        value=f"{format_timestamp(bot.current_timestamp)} / {format_timestamp(bot.current_duration)}"
-                    )
-                    await bot.playing_message.edit(embed=embed)
-                except discord.NotFound:
-                    logger.warning("Playing message not found, stopping UI updates")
-                    update_ui.stop()  # Stop the task if the message is gone
-                except Exception as e:
-                    logger.error(f"Error updating UI: {e}")
-                    # Don't stop the task for other errors
-        elif bot.is_paused or bot.seeking:
-            # Don't increment time when paused or seeking
-            pass
-        else:
-            if not vc.is_connected():
-                logger.warning("Voice client disconnected, stopping UI updates")
-                update_ui.stop()
-    except Exception as e:
-        logger.error(f"Exception in update_ui task: {e}")
-        # Don't stop the task for general errors
-
-@update_ui.before_loop
-async def before_update_ui():
-    await bot.wait_until_ready()
+    player.playing_message = await send_followup(interaction, embed=embed, view=view)
 
 # Format Timestamp
 def format_timestamp(seconds):
@@ -497,78 +3377,125 @@ def format_timestamp(seconds):
         return f"{hours:02}:{minutes:02}:{seconds:02}"
     return f"{minutes:02}:{seconds:02}"
 
+# Build the /queue embed for one page - only that page's songs are formatted
+def build_queue_embed(player, page):
+    embed = discord.Embed(title="🎶 Music Queue", color=discord.Color.blue())
+
+    if player.current_song and player.playing_message:
+        try:
+            embed.description = "**Currently Playing:**\n" + player.playing_message.embeds[0].description
+        except Exception:
+            embed.description = "**Currently Playing a song**"
+    elif not player.queue:
+        embed.description = "Nothing is playing and the queue is empty."
+        return embed
+
+    pages = player.queue_pages
+    if not player.queue:
+        embed.add_field(name="Queue", value="No songs in queue")
+        return embed
+
+    start = page * QUEUE_PAGE_SIZE + 1
+    end = min(start + QUEUE_PAGE_SIZE - 1, len(player.queue))
+    embed.add_field(name=f"Queue (Songs {start}-{end})", value=pages.page(page), inline=False)
+    embed.set_footer(text=f"Page {page + 1}/{pages.page_count()} • {len(player.queue)} songs • {format_timestamp(player.queue.total_duration)} remaining")
+    return embed
+
+# Previous/next buttons for a /queue message
+class QueueView(discord.ui.View):
+    def __init__(self, player):
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT)
+        self.player = player
+        self.page = 0
+        self.message = None
+        self.sync_buttons()
+
+    def sync_buttons(self):
+        # The queue may have shrunk since the last render
+        self.page = max(0, min(self.page, self.player.queue_pages.page_count() - 1))
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page >= self.player.queue_pages.page_count() - 1
+
+    async def show(self, interaction, step):
+        self.page += step
+        self.sync_buttons()
+        await interaction.response.edit_message(embed=build_queue_embed(self.player, self.page), view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, -1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, 1)
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
 # Queue Command
 @bot.tree.command(name="queue", description="Display the current song queue")
 async def queue_command(interaction: discord.Interaction):
     await interaction.response.defer()
-    
-    if not bot.queue:
-        if bot.current_song and bot.playing_message:
-            try:
-                embed = discord.Embed(
-                    title="🎶 Music Queue",
-                    description="**Currently Playing:**\n" + bot.playing_message.embeds[0].description,
-                    color=discord.Color.blue()
-                )
-                embed.add_field(name="Queue", value="No songs in queue")
-            except Exception:
-                embed = discord.Embed(
-                    title="🎶 Music Queue",
-                    description="Currently playing a song, but there's no queue.",
-                    color=discord.Color.blue()
-                )
-        else:
-            embed = discord.Embed(
-                title="🎶 Music Queue",
-                description="Nothing is playing and the queue is empty.",
-                color=discord.Color.blue()
-            )
+    player = bot.get_player(interaction.guild)
+
+    embed = build_queue_embed(player, 0)
+    if player.queue_pages.page_count() > 1:
+        view = QueueView(player)
+        view.message = await interaction.followup.send(embed=embed, view=view, wait=True)
     else:
-        embed = discord.Embed(
-            title="🎶 Music Queue",
-            color=discord.Color.blue()
-        )
-        
-        if bot.current_song and bot.playing_message:
-            try:
-                embed.description = "**Currently Playing:**\n" + bot.playing_message.embeds[0].description
-            except Exception:
-                embed.description = "**Currently Playing a song**"
-        
-        queue_text = ""
-        for i, (_, title, duration) in enumerate(bot.queue, 1):
-            queue_text += f"{i}. **{title}** ({format_timestamp(duration)})\n"
-            
-            # Split into multiple fields if queue is too long
-            if i % 10 == 0:
-                embed.add_field(name=f"Queue (Songs {i-9}-{i})", value=queue_text, inline=False)
-                queue_text = ""
-        
-        if queue_text:
-            embed.add_field(name="Queue", value=queue_text, inline=False)
-    
-    await interaction.followup.send(embed=embed)
+        await interaction.followup.send(embed=embed)
 
 # Remove Command
 @bot.tree.command(name="remove", description="Remove a song from the queue")
 @app_commands.describe(position="Position of the song in the queue (use /queue to see positions)")
 async def remove_command(interaction: discord.Interaction, position: int):
-    if not bot.queue:
+    player = bot.get_player(interaction.guild)
+    if not player.queue:
         await interaction.response.send_message("The queue is empty!", ephemeral=True)
         return
     
-    if position < 1 or position > len(bot.queue):
-        await interaction.response.send_message(f"Invalid position. Please enter a number between 1 and {len(bot.queue)}.", ephemeral=True)
+    if position < 1 or position > len(player.queue):
+        await interaction.response.send_message(f"Invalid position. Please enter a number between 1 and {len(player.queue)}.", ephemeral=True)
         return
     
     # Convert position to 0-based index
-    index = position - 1
-    _, title, _ = bot.queue[index]
-    bot.queue.remove(bot.queue[index])
+    entry = player.queue.remove_at(position - 1)
+    # If the next song changed, its prefetched decoder is no longer wanted
+    sync_prefetch(player)
     
-    await interaction.response.send_message(f"Removed **{title}** from the queue.")
+    await interaction.response.send_message(f"Removed **{entry.title}** from the queue.")
 
-# Volume Command - modified to use play_audio_at_position
+# Move Command
+@bot.tree.command(name="move", description="Move a song to a different position in the queue")
+@app_commands.describe(position="Current position of the song", new_position="Position to move it to")
+async def move_command(interaction: discord.Interaction, position: int, new_position: int):
+    player = bot.get_player(interaction.guild)
+    size = len(player.queue)
+    if not 1 <= position <= size or not 1 <= new_position <= size:
+        await interaction.response.send_message(f"Invalid position. Please enter numbers between 1 and {size}.", ephemeral=True)
+        return
+
+    entry = player.queue.move(position - 1, new_position - 1)
+    sync_prefetch(player)
+    await interaction.response.send_message(f"Moved **{entry.title}** to position {new_position}.")
+
+# Shuffle Command
+@bot.tree.command(name="shuffle", description="Shuffle the songs in the queue")
+async def shuffle_command(interaction: discord.Interaction):
+    player = bot.get_player(interaction.guild)
+    if len(player.queue) < 2:
+        await interaction.response.send_message("Not enough songs in the queue to shuffle.", ephemeral=True)
+        return
+
+    player.queue.shuffle()
+    sync_prefetch(player)
+    await interaction.response.send_message(f"Shuffled {len(player.queue)} songs.")
+
+# Volume Command - applied in the audio source when possible, otherwise via play_audio_at_position
 @bot.tree.command(name="volume", description="Set the volume of the player (0-100)")
 @app_commands.describe(level="Volume level from 0 to 100")
 async def volume_command(interaction: discord.Interaction, level: int):
@@ -576,34 +3503,48 @@ async def volume_command(interaction: discord.Interaction, level: int):
         await interaction.response.send_message("Volume must be between 0 and 100", ephemeral=True)
         return
     
-    # Store the volume level
-    bot.volume = level
+    # Store the volume level for this guild
+    player = bot.get_player(interaction.guild)
+    player.volume = level
     
     # Apply volume immediately if playing
     if interaction.guild.voice_client and (interaction.guild.voice_client.is_playing() or interaction.guild.voice_client.is_paused()):
         await interaction.response.defer()
         
         vc = interaction.guild.voice_client
-        if vc.is_playing() or vc.is_paused():
+        if isinstance(player.current_source, PCM_SOURCES):
+            # Change the gain in place - no ffmpeg restart, no gap
+            player.current_source.volume = track_volume(player, player.current_video_id)
+        elif vc.is_playing() or vc.is_paused():
+            # A prefetched Opus decoder has the old volume baked in
+            discard_prefetch(player)
             # Set the seeking flag to prevent multiple operations
-            bot.seeking = True
+            player.seeking = True
             was_paused = vc.is_paused()
-            current_position = bot.current_timestamp
+            current_position = player.current_timestamp
             
             # Play audio with new volume at current position
-            await play_audio_at_position(vc, interaction, bot.current_song, current_position, bot.current_duration)
+            await play_audio_at_position(vc, interaction, player.current_song, current_position, player.current_duration)
             
             # Restore pause state
             if was_paused:
                 vc.pause()
-                bot.is_paused = True
+                player.is_paused = True
             
-            bot.seeking = False
+            player.seeking = False
         
         await interaction.followup.send(f"Volume set to {level}%")
     else:
         await interaction.response.send_message(f"Volume set to {level}% (will apply to next song)", ephemeral=True)
 
+# Try to seek within the current source's buffered audio
+def seek_in_buffer(player, seconds):
+    source = player.current_source
+    if isinstance(source, PCM_SOURCES) and source.seek(seconds):
+        bot.ui_scheduler.request(player, urgent=True)
+        return True
+    return False
+
 # Playback Controls
 class PlaybackControls(discord.ui.View):
     def __init__(self):
@@ -613,68 +3554,73 @@ class PlaybackControls(discord.ui.View):
     async def pause(self, interaction: discord.Interaction, button: discord.ui.Button):
         # Just acknowledge the interaction to keep the button responsive
         await interaction.response.defer(ephemeral=True)
+        player = bot.get_player(interaction.guild)
         
         vc = interaction.guild.voice_client
-        if vc and vc.is_playing() and not bot.is_paused:
+        if vc and vc.is_playing() and not player.is_paused:
             vc.pause()
             button.label = "Resume"
-            bot.is_paused = True
+            player.is_paused = True
             await interaction.message.edit(view=self)
-        elif vc and vc.is_paused() and bot.is_paused:
+        elif vc and vc.is_paused() and player.is_paused:
             vc.resume()
             button.label = "Pause"
-            bot.is_paused = False
+            player.is_paused = False
             await interaction.message.edit(view=self)
 
     @discord.ui.button(label="Forward", style=discord.ButtonStyle.success)
     async def forward(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer(ephemeral=True)
+        player = bot.get_player(interaction.guild)
         
         # Check if we can perform seeking
-        if bot.seeking or not interaction.guild.voice_client or not bot.current_song:
+        if player.seeking or not interaction.guild.voice_client or not player.current_song:
             return
             
         # Set seeking flag and calculate new position
-        bot.seeking = True
+        player.seeking = True
         try:
-            old_timestamp = bot.current_timestamp
-            bot.current_timestamp = min(bot.current_duration, bot.current_timestamp + 10)
+            old_timestamp = player.current_timestamp
+            target = min(player.current_duration, old_timestamp + 10)
             
             # Only seek if position actually changed
-            if old_timestamp != bot.current_timestamp:
+            if old_timestamp != target:
                 vc = interaction.guild.voice_client
-                await play_audio_at_position(vc, interaction, bot.current_song, bot.current_timestamp, bot.current_duration)
-            else:
-                # If at the end already, no need to seek
-                bot.seeking = False
+                # Short seeks are served from the decoded-audio buffer; otherwise respawn ffmpeg
+                if not seek_in_buffer(player, target - old_timestamp):
+                    player.current_timestamp = target
+                    await play_audio_at_position(vc, interaction, player.current_song, target, player.current_duration)
         except Exception as e:
             logger.error(f"Error during forward: {e}")
-            bot.seeking = False
+        finally:
+            player.seeking = False
 
     @discord.ui.button(label="Backward", style=discord.ButtonStyle.success)
     async def backward(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer(ephemeral=True)
+        player = bot.get_player(interaction.guild)
         
         # Check if we can perform seeking
-        if bot.seeking or not interaction.guild.voice_client or not bot.current_song:
+        if player.seeking or not interaction.guild.voice_client or not player.current_song:
             return
             
         # Set seeking flag and calculate new position
-        bot.seeking = True
+        player.seeking = True
         try:
-            old_timestamp = bot.current_timestamp
-            bot.current_timestamp = max(0, bot.current_timestamp - 10)
+            old_timestamp = player.current_timestamp
+            target = max(0, old_timestamp - 10)
             
             # Only seek if position actually changed
-            if old_timestamp != bot.current_timestamp:
+            if old_timestamp != target:
                 vc = interaction.guild.voice_client
-                await play_audio_at_position(vc, interaction, bot.current_song, bot.current_timestamp, bot.current_duration)
-            else:
-                # If at the start already, no need to seek
-                bot.seeking = False
+                # Short seeks are served from the decoded-audio buffer; otherwise respawn ffmpeg
+                if not seek_in_buffer(player, target - old_timestamp):
+                    player.current_timestamp = target
+                    await play_audio_at_position(vc, interaction, player.current_song, target, player.current_duration)
         except Exception as e:
             logger.error(f"Error during backward: {e}")
-            bot.seeking = False
+        finally:
+            player.seeking = False
 
     @discord.ui.button(label="Stop", style=discord.ButtonStyle.red)
     async def stop(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -682,28 +3628,20 @@ class PlaybackControls(discord.ui.View):
         await interaction.response.defer(ephemeral=True)
         
         if interaction.guild.voice_client:
-            # Stop the UI update task
-            update_ui.stop()
-            
-            # Clean up processes
-            cleanup_processes()
+            # Stop UI updates, clean up processes and clear the queue for this guild only
+            bot.evict_player(interaction.guild.id)
             
-            # Disconnect and clear queue
+            # Disconnect
             await interaction.guild.voice_client.disconnect()
-            bot.queue.clear()
-            bot.current_song = None
-            bot.current_timestamp = 0
-            bot.is_paused = False
-            bot.seeking = False
-            bot.current_process = None
 
     @discord.ui.button(label="Skip", style=discord.ButtonStyle.danger)
     async def skip(self, interaction: discord.Interaction, button: discord.ui.Button):
         # Acknowledge the interaction to keep the button responsive
         await interaction.response.defer(ephemeral=True)
+        player = bot.get_player(interaction.guild)
         
         # Prevent multiple clicks from causing issues
-        if bot.seeking:
+        if player.seeking:
             return
             
         vc = interaction.guild.voice_client
@@ -711,26 +3649,61 @@ class PlaybackControls(discord.ui.View):
             return
 
         if vc.is_playing() or vc.is_paused():
-            bot.seeking = True  # Set flag to prevent auto-play
+            player.seeking = True  # Set flag to prevent auto-play
             
-            # Stop current playback
+            # Stop current playback; detaching the chain makes its after-callback a no-op
+            player.audio_chain = None
             vc.stop()
             
             # Clean up processes
-            cleanup_processes()
+            cleanup_processes(player)
             
             # Make sure we are not trying to send a new UI if the previous message was deleted
-            if bot.playing_message:
+            if player.playing_message:
+                bot.ui_scheduler.forget(player.playing_message.id)
                 try:
-                    await bot.playing_message.delete()  # Delete old message if it exists
+                    await player.playing_message.delete()  # Delete old message if it exists
                 except discord.NotFound:
                     pass  # If the message was already deleted, ignore
                 except Exception as e:
                     logger.error(f"Error deleting message during skip: {e}")
             
-            bot.seeking = False
+            player.seeking = False
             await play_next_in_queue(vc, interaction)
 
+# Stats command - where the time goes, without needing the metrics endpoint
+def format_latency(seconds):
+    if seconds is None:
+        return "n/a"
+    if seconds == float("inf"):
+        return "slow"
+    return f"≤{seconds * 1000:.1f}ms" if seconds < 1 else f"≤{seconds:g}s"
+
+@bot.tree.command(name="stats", description="Show playback pipeline statistics")
+async def stats_command(interaction: discord.Interaction):
+    embed = discord.Embed(title="📊 Bot Stats", color=discord.Color.blue())
+    embed.add_field(name="Players", value=f"{len(bot.players)} active, {len(bot.voice_clients)} in voice")
+    for label, histogram in (("Extraction", metrics.extraction_seconds), ("Time to first audio", metrics.first_audio_seconds),
+                             ("Frame read", metrics.frame_read_seconds), ("Event loop lag", metrics.loop_lag_seconds)):
+        embed.add_field(
+            name=label,
+            value=f"p50 {format_latency(histogram.quantile(0.5))} • p99 {format_latency(histogram.quantile(0.99))} ({histogram.count})"
+        )
+    stats = bot.component_stats()
+    embed.add_field(name="Playback", value=f"{metrics.underruns.value} underruns • {metrics.recoveries.value} recoveries • {metrics.reconnects.value} reconnects")
+    embed.add_field(name="ffmpeg", value=f"{stats['ffmpeg']['alive']} running • {stats['ffmpeg']['spawned']} started")
+    embed.add_field(name="UI edits", value=f"{stats['ui']['edits_sent']} sent • {stats['ui']['edits_dropped']} dropped • {stats['ui']['requests_coalesced']} coalesced • {stats['ui']['rate_limited']} rate limited")
+    embed.add_field(name="Metadata cache", value=f"{stats['metadata_cache']['hits']} hits • {stats['metadata_cache']['misses']} misses")
+    if bot.audio_cache.enabled:
+        embed.add_field(name="Audio cache", value=f"{stats['audio_cache']['hits']} hits • {stats['audio_cache']['misses']} misses")
+    if SHARDED:
+        shards = bot.shard_stats()
+        slowest = max((s["latency_seconds"] for s in shards.values() if s["latency_seconds"] is not None), default=None)
+        embed.add_field(name="Shards", value=f"{len(shards)} of {bot.shard_count} in this process • slowest gateway {format_latency(slowest)}")
+    if bot.ready_seconds is not None:
+        embed.set_footer(text=f"Ready in {bot.ready_seconds:.2f}s")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 # Ping command to check bot latency
 @bot.tree.command(name="ping", description="Check the bot's latency")
 async def ping_command(interaction: discord.Interaction):
@@ -740,7 +3713,15 @@ async def ping_command(interaction: discord.Interaction):
     end_time = time.time()
     latency = (end_time - start_time) * 1000
     
-    await interaction.edit_original_response(content=f"Pong! Latency: {latency:.2f}ms | Discord API: {bot.latency * 1000:.2f}ms")
+    shard_id = interaction.guild.shard_id if interaction.guild else 0
+    gateway = bot.shard_latency(shard_id)
+    gateway_text = f"{gateway * 1000:.2f}ms" if gateway is not None else "n/a"
+    if SHARDED:
+        gateway_text += f" (shard {shard_id})"
+    await interaction.edit_original_response(content=f"Pong! Latency: {latency:.2f}ms | Discord API: {gateway_text}")
 
 
-bot.run("Post ur token here")
+if __name__ == "__main__":
+    setup_logging()
+    # Our queue-based logging is already configured; don't let discord.py add a blocking handler
+    bot.run("Post ur token here", log_handler=None)
@@ -0,0 +1,137 @@
+# Code that runs inside child processes. Spawned workers import this module instead of musicbot.py,
+# so keep it free of import-time side effects: no logging setup, no bot, no cache or state access.
+import audioop
+import subprocess
+import threading
+
+from discord import opus
+
+FRAME_SIZE = 3840  # Bytes in a 20ms frame of 48kHz stereo s16le
+
+# Fill one frame slot from ffmpeg's pipe; a short final frame is padded with silence.
+# Returns the number of bytes read, which is only short at the end of the stream.
+def read_frame_into(source, target):
+    got = 0
+    while got < FRAME_SIZE:
+        n = source.readinto(target[got:])
+        if not n:
+            break
+        got += n
+    if 0 < got < FRAME_SIZE:
+        target[got:] = bytes(FRAME_SIZE - got)
+    return got
+
+# Runs inside an extraction pool worker - process pools pickle it by reference to this module
+def extract_info_blocking(url, ydl_opts):
+    # yt-dlp is slow to import, so only the workers that actually extract pay for it
+    from yt_dlp import YoutubeDL
+    with YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+        # Strip non-picklable internals so the result can cross process boundaries
+        return ydl.sanitize_info(info)
+
+# Audio worker process entry point - reads jobs from the bot and streams Opus packets back
+def audio_worker_main(conn):
+    try:
+        if not opus.is_loaded():
+            opus._load_default()
+        ready = opus.is_loaded()
+    except Exception:
+        ready = False
+    conn.send(("ready", ready))
+    if not ready:
+        return
+
+    send_lock = threading.Lock()
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    jobs = {}
+    while True:
+        try:
+            kind, job_id, *payload = conn.recv()
+        except (EOFError, OSError):
+            break
+        if kind == "start":
+            command, volume, credit, bitrate, batch_frames = payload
+            jobs[job_id] = AudioWorkerJob(job_id, command, volume, credit, bitrate, batch_frames, send)
+        elif job_id in jobs:
+            job = jobs[job_id]
+            if kind == "credit":
+                job.add_credit(payload[0])
+            elif kind == "volume":
+                job.volume = payload[0]
+            elif kind == "stop":
+                job.stop()
+                del jobs[job_id]
+    # The bot went away - don't leave ffmpeg behind
+    for job in jobs.values():
+        job.stop()
+
+# One decode inside a worker: ffmpeg -> volume -> Opus, paced by credits from the bot so a paused
+# or not-yet-started stream stops decoding instead of piling packets up
+class AudioWorkerJob:
+    def __init__(self, job_id, command, volume, credit, bitrate, batch_frames, send):
+        self.job_id = job_id
+        self.volume = volume
+        self.credit = credit
+        self.batch_frames = batch_frames
+        self.send = send
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.encoder = opus.Encoder()
+        self.encoder.set_bitrate(bitrate)
+        self.process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=8192)
+        threading.Thread(target=self._run, name=f"audio-job-{job_id}", daemon=True).start()
+
+    def add_credit(self, frames):
+        with self.cond:
+            self.credit += frames
+            self.cond.notify()
+
+    def _run(self):
+        frame = bytearray(FRAME_SIZE)
+        view = memoryview(frame)
+        batch = []
+        try:
+            while True:
+                with self.cond:
+                    while self.credit <= 0 and not self.stopped:
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                    self.credit -= 1
+                    out_of_credit = self.credit == 0
+                got = read_frame_into(self.process.stdout, view)
+                if got:
+                    pcm = audioop.mul(frame, 2, self.volume) if self.volume != 1.0 else bytes(frame)
+                    batch.append(self.encoder.encode(pcm, self.encoder.SAMPLES_PER_FRAME))
+                if batch and (len(batch) >= self.batch_frames or out_of_credit or got < FRAME_SIZE):
+                    self.send(("frames", self.job_id, batch))
+                    batch = []
+                if got < FRAME_SIZE:
+                    self.send(("eof", self.job_id))
+                    return
+        except (OSError, EOFError, ValueError):
+            pass  # Pipe to the bot or to ffmpeg closed under us
+        finally:
+            self._terminate()
+
+    def _terminate(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stdout.close()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        # A job blocked on ffmpeg's pipe notices once ffmpeg is gone
+        if self.process.poll() is None:
+            self.process.terminate()